@@ -4,7 +4,13 @@ Created on Thu May 21 17:20:49 2015
 
 @author: federico/luciano
 """
+import multiprocessing
 
-from tormenta import main
+# The writer processes import this module again when they start (spawn, on
+# Windows), they must not open the instruments or the GUI
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
 
-main()
+    from tormenta import main
+
+    main()
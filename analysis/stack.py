@@ -5,6 +5,9 @@ Created on Sun Dec 22 16:44:59 2013
 @author: federico
 """
 
+import time
+import threading
+
 import numpy as np
 import matplotlib.pyplot as plt
 import h5py as hdf
@@ -127,6 +130,133 @@ class Stack(object):
         self.file.close()
 
 
+class LiveStack(object):
+    """Recording that may still be written, read through HDF5 SWMR.
+
+    Tempesta writes its HDF5 recordings in SWMR mode and commits the number
+    of frames in the 'FrameCount' dataset after their data, so the frames
+    up to it can be read safely while the recording goes on. Frames are
+    numbered in acquisition order across the planes and time points of
+    scans, (t, z, frame, x, y) datasets, or 'z<i>' groups in older files.
+    Older files, without 'FrameCount', are read as they are, with all the
+    frames of their datasets. Analysis
+    running in Tempesta itself doesn't need the file: it can subscribe to
+    the LVWorker of the camera, that hands every new run of frames to its
+    subscribers.
+
+        stack = LiveStack('rec.hdf5')
+        for start, frames, metadata in stack.follow():
+            ...
+    """
+
+    def __init__(self, filename, imagename='Images'):
+
+        try:
+            self.file = hdf.File(filename, 'r', libver='latest', swmr=True)
+            self.swmr = True
+        except OSError:
+            # Not written for SWMR, a finished recording
+            self.file = hdf.File(filename, 'r')
+            self.swmr = False
+        self.planes = None
+        if imagename in self.file:
+            self.datasets = [self.file[imagename]]
+            if self.datasets[0].ndim == 5:
+                self.planes = self.datasets[0].shape[1]
+        else:
+            planes = sorted((name for name in self.file
+                             if name.startswith('z')),
+                            key=lambda name: int(name[1:]))
+            self.datasets = [self.file[name][imagename] for name in planes]
+        self.count = self.file.get('FrameCount')
+        self.metadata = self.file.get('FrameMetadata')
+        self.attrs = self.file.attrs
+        self.frame = 0      # first frame not returned by follow yet
+        self.nframes = 0
+        self.refresh()
+
+    def refresh(self):
+        """Updates nframes to the frames committed by the writer."""
+        if self.swmr:
+            # The count first, the data it counts is already there
+            if self.count is not None:
+                self.count.refresh()
+            for dataset in self.datasets:
+                dataset.refresh()
+            if self.metadata is not None:
+                self.metadata.refresh()
+        if self.count is None:
+            self.nframes = sum(len(dataset) for dataset in self.datasets)
+        else:
+            self.nframes = int(self.count[0])
+        return self.nframes
+
+    def read(self, start, stop):
+        """Frames in [start, stop) as an (n, x, y) array, with their
+        metadata records (None if the recording has none)."""
+        stop = min(stop, self.nframes)
+        images = self.datasets[0]
+        if self.planes is None:
+            plane_frames = max(1, len(images))
+        else:
+            plane_frames = images.shape[2]
+        chunks = []
+        i = start
+        while i < stop:
+            plane, index = divmod(i, plane_frames)
+            n = min(stop - i, plane_frames - index)
+            if self.planes is None:
+                chunks.append(self.datasets[plane][index:index + n])
+            else:
+                t, z = divmod(plane, self.planes)
+                chunks.append(images[t, z, index:index + n])
+            i += n
+        if len(chunks) == 0:
+            frames = np.empty((0,) + images.shape[-2:], dtype=images.dtype)
+        else:
+            frames = np.concatenate(chunks)
+        metadata = None
+        if self.metadata is not None:
+            metadata = self.metadata[start:stop]
+        return frames, metadata
+
+    def follow(self, timeout=5, interval=0.1, max_frames=None):
+        """Yields (start, frames, metadata) with the new frames as they are
+        committed, at most max_frames at a time, until none arrive for
+        timeout seconds. Close the stack then, so that the writer can store
+        the final attributes."""
+        last = time.time()
+        while True:
+            if self.frame >= self.nframes:
+                self.refresh()
+            if self.frame < self.nframes:
+                stop = self.nframes
+                if max_frames is not None:
+                    stop = min(stop, self.frame + max_frames)
+                frames, metadata = self.read(self.frame, stop)
+                start = self.frame
+                self.frame = stop
+                last = time.time()
+                yield start, frames, metadata
+            elif time.time() - last > timeout:
+                return
+            else:
+                time.sleep(interval)
+
+    def watch(self, callback, **kwargs):
+        """Calls callback(start, frames, metadata) from a thread with the
+        new frames, see follow. Returns the thread."""
+        def run():
+            for args in self.follow(**kwargs):
+                callback(*args)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.file.close()
+
+
 def bkg_estimation(data_stack, window=100):
     ''' Background estimation. It's a running (time) mean.
     Hoogendoorn et al. in "The fidelity of stochastic single-molecule
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 12 10:02:41 2026
+
+@author: Tempesta_team
+"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+class RecordingBuffer(object):
+    """ Contiguous (n, x, y) store for the nFrames frames of a recording.
+
+    The whole array is preallocated, in memory if it fits in maxMemory,
+    otherwise in a memory-mapped scratch file. Frames are appended at a
+    monotonically increasing write cursor, those that do not fit are
+    dropped, and readers take slices up to that cursor, so nothing is ever
+    copied out of the buffer to be read."""
+
+    def __init__(self, shape, nFrames, dtype=np.uint16, scratchDir=None,
+                 maxMemory=4*1024**3):
+
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.frameBytes = self.dtype.itemsize * int(np.prod(self.shape))
+        self.scratch = None
+
+        self.cursor = 0     # number of frames written
+        self.dropped = 0    # frames that did not fit in the buffer
+
+        if nFrames * self.frameBytes > maxMemory:
+            self.scratch = tempfile.TemporaryFile(dir=scratchDir,
+                                                  suffix='.rec')
+            self.data = np.memmap(self.scratch, dtype=self.dtype, mode='r+',
+                                  shape=(nFrames,) + self.shape)
+        else:
+            self.data = np.empty((nFrames,) + self.shape, dtype=self.dtype)
+
+    def __len__(self):
+        return self.cursor
+
+    @property
+    def capacity(self):
+        return len(self.data)
+
+    def write(self, frames):
+        """ Appends frames (an (n, x, y) array or a sequence of (x, y)
+        arrays) at the cursor."""
+        start = self.cursor
+        n = len(frames)
+        if start + n > self.capacity:
+            if self.dropped == 0:
+                print('Recording buffer full, dropping frames')
+            self.dropped += start + n - self.capacity
+            n = self.capacity - start
+
+        self.data[start:start + n] = frames[:n]
+
+        # Only move the cursor once the data is in place
+        self.cursor = start + n
+
+    def read(self, start=0, stop=None):
+        """ View of the frames in [start, stop), stop defaults to the
+        cursor."""
+        if stop is None:
+            stop = self.cursor
+        return self.data[start:min(stop, self.cursor)]
+
+    def close(self):
+        self.data = None
+        if self.scratch is not None:
+            self.scratch.close()
+            self.scratch = None
+
+
+class FrameQueue(object):
+    """ Bounded ring of frames between the acquisition thread, that writes
+    them, and a recording thread, that reads and stores them.
+
+    Frames stay in place until the reader releases them, so reading copies
+    nothing. When the ring is full the writer waits up to blockTime for the
+    reader to catch up and then drops the frames that do not fit. The
+    largest number of frames that were waiting at any time is kept in
+    highWater."""
+
+    def __init__(self, shape, capacity, dtype=np.uint16, blockTime=0.05):
+
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        self.blockTime = blockTime
+        self.data = np.empty((self.capacity,) + self.shape, dtype=self.dtype)
+        self.metadata = None
+
+        self.head = 0       # frames written
+        self.tail = 0       # frames released by the reader
+        self.dropped = 0    # frames that did not fit
+        self.highWater = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def write(self, frames, metadata=None):
+        """ Appends frames (an (n, x, y) array) and their metadata records if
+        given, waiting up to blockTime for free space."""
+        n = len(frames)
+        done = 0
+        deadline = time.perf_counter() + self.blockTime
+        while done < n:
+            with self.cond:
+                free = self.capacity - (self.head - self.tail)
+                if free == 0:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        if self.dropped == 0:
+                            print('Recording queue full, dropping frames')
+                        self.dropped += n - done
+                        return
+                    self.cond.wait(remaining)
+                    continue
+
+            # Only the writer touches the free part of the ring
+            start = self.head % self.capacity
+            k = min(n - done, free, self.capacity - start)
+            self.data[start:start + k] = frames[done:done + k]
+            if metadata is not None:
+                if self.metadata is None:
+                    self.metadata = np.zeros(self.capacity,
+                                             dtype=metadata.dtype)
+                self.metadata[start:start + k] = metadata[done:done + k]
+
+            with self.cond:
+                self.head += k
+                self.highWater = max(self.highWater, self.head - self.tail)
+                self.cond.notify_all()
+            done += k
+
+    def read(self, maxFrames=None, timeout=None):
+        """ Waits up to timeout seconds for frames and returns a view of the
+        oldest ones that are contiguous in the ring, with their metadata
+        (None if there is none). They must be released once stored."""
+        with self.cond:
+            if self.head == self.tail and not self.closed:
+                self.cond.wait(timeout)
+            head = self.head
+
+        start = self.tail % self.capacity
+        stop = start + min(head - self.tail, self.capacity - start)
+        if maxFrames is not None:
+            stop = min(stop, start + maxFrames)
+        metadata = None
+        if self.metadata is not None:
+            metadata = self.metadata[start:stop]
+        return self.data[start:stop], metadata
+
+    def release(self, n):
+        """ Gives back to the writer the space of the n oldest frames."""
+        with self.cond:
+            self.tail += n
+            self.cond.notify_all()
+
+    def close(self):
+        """ No more frames will be written, wakes up a waiting reader."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class SharedFrameQueue(object):
+    """ FrameQueue for a reader in another process. The ring of frames lives
+    in shared memory and the acquisition thread copies the frames into it
+    once; only their descriptors, (start, n, metadata), go through a
+    multiprocessing queue, followed by None when it is closed. The reader
+    attaches to the ring with attachRing(*queue.ring()) and gives the space
+    back by adding the frames it is done with to the shared released
+    counter. Has the same counters as FrameQueue."""
+
+    def __init__(self, shape, capacity, dtype=np.uint16, blockTime=0.05):
+
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        self.blockTime = blockTime
+        nbytes = self.capacity * self.dtype.itemsize * int(np.prod(self.shape))
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.data = np.ndarray((self.capacity,) + self.shape, self.dtype,
+                               buffer=self.shm.buf)
+        self.descriptors = mp.Queue()
+        self.released = mp.RawValue('q', 0)
+
+        self.head = 0       # frames written
+        self.dropped = 0    # frames that did not fit
+        self.highWater = 0
+        self.closed = False
+
+    @property
+    def tail(self):
+        return self.released.value
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def ring(self):
+        """ Arguments of attachRing for the reader process."""
+        return self.shm.name, self.shape, self.capacity, self.dtype.str
+
+    def write(self, frames, metadata=None):
+        """ Appends frames (an (n, x, y) array) and their metadata records if
+        given, waiting up to blockTime for the reader to free space."""
+        n = len(frames)
+        done = 0
+        deadline = time.perf_counter() + self.blockTime
+        while done < n:
+            free = self.capacity - (self.head - self.tail)
+            if free == 0:
+                if time.perf_counter() >= deadline:
+                    if self.dropped == 0:
+                        print('Recording queue full, dropping frames')
+                    self.dropped += n - done
+                    return
+                time.sleep(0.001)
+                continue
+
+            start = self.head % self.capacity
+            k = min(n - done, free, self.capacity - start)
+            self.data[start:start + k] = frames[done:done + k]
+            if metadata is not None:
+                self.descriptors.put(
+                    (start, k, np.array(metadata[done:done + k])))
+            else:
+                self.descriptors.put((start, k, None))
+            self.head += k
+            self.highWater = max(self.highWater, self.head - self.tail)
+            done += k
+
+    def close(self):
+        """ No more frames will be written, tells the reader."""
+        if not self.closed:
+            self.closed = True
+            self.descriptors.put(None)
+
+    def destroy(self):
+        """ Frees the shared memory, once the reader is gone."""
+        self.data = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attachRing(name, shape, capacity, dtype):
+    """ Shared memory block and (capacity, x, y) frame array of the ring of a
+    SharedFrameQueue, from another process."""
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray((capacity,) + tuple(shape), np.dtype(dtype),
+                      buffer=shm.buf)
+    return shm, data
+
+
+class RecordingStats(object):
+    """ Live metrics of a recording that goes through a FrameQueue or a
+    SharedFrameQueue, updated by the recording thread as frames are written
+    and read by the GUI: frames acquired and written, queue depth, disk
+    throughput, worst write latency, camera backlog and frames that did not
+    make it to the file."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.written = 0
+        self.bytesWritten = 0
+        self.writeTime = 0
+        self.worstLatency = 0
+        self.backlog = 0
+        self.maxBacklog = 0
+        self.missing = 0        # gaps in the frame numbers, for any reason
+        self.overwritten = 0    # frames the camera overwrote before queuing
+        self.lastNumber = None
+
+    @property
+    def acquired(self):
+        return self.queue.head + self.queue.dropped
+
+    def wrote(self, n, nbytes, seconds, metadata=None):
+        """ Accounts for a batch of n frames, nbytes of data, written in
+        seconds."""
+        self.written += n
+        self.bytesWritten += nbytes
+        self.writeTime += seconds
+        self.worstLatency = max(self.worstLatency, seconds)
+
+        if metadata is not None and len(metadata) > 0:
+            numbers = metadata['frame_number']
+            if self.lastNumber is not None:
+                self.missing += max(0, int(numbers[0]) - self.lastNumber - 1)
+            gaps = np.diff(numbers) - 1
+            self.missing += int(gaps[gaps > 0].sum())
+            self.lastNumber = int(numbers[-1])
+            self.backlog = int(metadata['backlog'][-1])
+            self.maxBacklog = max(self.maxBacklog,
+                                  int(metadata['backlog'].max()))
+
+    def mbPerSecond(self):
+        """ Measured write throughput in MB/s."""
+        if self.writeTime == 0:
+            return 0
+        return self.bytesWritten / self.writeTime / 1024**2
+
+    def healthy(self):
+        """ False once frames are being lost or the queue is over half
+        full."""
+        return (self.queue.dropped == 0 and self.missing == 0 and
+                self.overwritten == 0 and
+                len(self.queue) <= self.queue.capacity // 2)
+
+    def summary(self):
+        """ (name, value) pairs to store with the recording."""
+        return [('Rec frames acquired', self.acquired),
+                ('Rec frames written', self.written),
+                ('Rec frames missing', self.missing),
+                ('Rec frames dropped by queue', self.queue.dropped),
+                ('Rec frames overwritten in camera', self.overwritten),
+                ('Rec queue capacity', self.queue.capacity),
+                ('Rec queue peak', self.queue.highWater),
+                ('Rec write MB/s', round(self.mbPerSecond(), 1)),
+                ('Rec worst write latency [ms]',
+                 round(1000 * self.worstLatency, 1)),
+                ('Rec max camera backlog', self.maxBacklog)]
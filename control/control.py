@@ -23,6 +23,9 @@ import control.scanner as scanner
 import control.guitools as guitools
 import control.focus as focus
 import control.recording as record
+import control.buffers as buffers
+import control.display as display
+import control.framestats as framestats
 
 
 class CamParamTree(ParameterTree):
@@ -140,6 +143,9 @@ class CamParamTree(ParameterTree):
 
 
 class LVWorker(QtCore.QObject):
+    """ Acquisition loop of one camera. It waits for new frames with a bounded
+    timeout, so that it can be stopped at any time, and publishes them to
+    the display and to the subscribed consumers (recorder, analysis)."""
 
     def __init__(self, main, ind, orcaflash, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -149,7 +155,19 @@ class LVWorker(QtCore.QObject):
         self.orcaflash = orcaflash
         self.running = False
         self.recording = False
-        self.fRecorded = []
+        self.recBuffer = None
+        # Frames overwritten by the camera before they were copied to the
+        # recording buffer.
+        self.nOverwritten = 0
+
+        # Callables that get every list of new runs of frames (at most two
+        # runs of consecutive camera buffers each time), called from the
+        # acquisition thread. The list is replaced, never modified in place,
+        # so that it can be changed while the loop is iterating it.
+        self.subscribers = []
+        # Maximum time in ms to wait for a frame before checking if the loop
+        # was stopped.
+        self.timeout = 100
 
         # Memory variable to keep track of if update has been run many times in
         # a row with camera trigger source as internal trigger
@@ -158,52 +176,41 @@ class LVWorker(QtCore.QObject):
         # Happens when using external start tigger.
 
     def run(self):
-        self.vtimer = QtCore.QTimer()
-        self.vtimer.timeout.connect(self.update)
         self.running = True
-        self.vtimer.start(30)
-        time.sleep(0.03)
-
-        # Grab first frame only to set suitable histogram limits
-        hcData = self.orcaflash.getFrames()[0]
-        frame = hcData[0].getData()
-        self.image = np.reshape(
-            frame, (self.orcaflash.frame_x, self.orcaflash.frame_y), 'F')
+        while self.running:
+            # The camera is idle while its parameters are being changed
+            if not self.orcaflash.acquiring:
+                time.sleep(0.01)
+                continue
+
+            runs = self.orcaflash.getFrameRuns(self.timeout)
+            if len(runs) == 0:
+                continue
+            self.publish(runs)
+
+    def publish(self, runs):
+        self.image = runs[-1].getImage()
         self.main.latest_images[self.ind] = self.image
-        self.main.hist.setLevels(*guitools.bestLimits(self.image))
-        self.main.hist.vb.autoRange()
+        self.main.latest_seqs[self.ind] += sum(len(run) for run in runs)
 
-    def update(self):
-        if self.running:
-            try:
-                hcData = self.orcaflash.getFrames()[0]
-                frame = hcData[0].getData()
-                self.image = np.reshape(
-                    frame, (self.orcaflash.frame_x, self.orcaflash.frame_y),
-                    'F')
-                self.main.latest_images[self.ind] = self.image
-
-                # stock frames while recording
-                # TODO: don't store data in a list. We should create an array
-                #       because we know the nFrames beforehand
-                if self.recording:
-                    for hcDatum in hcData:
-                        reshapedFrame = np.reshape(hcDatum.getData(),
-                                                   (self.orcaflash.frame_x,
-                                                    self.orcaflash.frame_y),
-                                                   'F')
-                        self.fRecorded.append(reshapedFrame)
-
-                """Following is causing problems with two cameras..."""
-    #            trigSource = self.orcaflash.getPropertyValue('trigSource')[0]
-    #            if trigSource == 1:
-    #                if self.mem == 3:
-    #                    self.main.trigsourceparam.setValue('Internal trigger')
-    #                    self.mem = 0
-    #                else:
-    #                    self.mem = self.mem + 1
-            except IndexError:
-                pass
+        for callback in self.subscribers:
+            callback(runs)
+
+        """Following is causing problems with two cameras..."""
+#        trigSource = self.orcaflash.getPropertyValue('trigSource')[0]
+#        if trigSource == 1:
+#            if self.mem == 3:
+#                self.main.trigsourceparam.setValue('Internal trigger')
+#                self.mem = 0
+#            else:
+#                self.mem = self.mem + 1
+
+    def subscribe(self, callback):
+        if callback not in self.subscribers:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [c for c in self.subscribers if c != callback]
 
     def stop(self):
         if self.running:
@@ -211,11 +218,26 @@ class LVWorker(QtCore.QObject):
         else:
             print('Cannot stop when not running (from LVThread)')
 
-    def startRecording(self):
+    def record(self, runs):
+        """ Stocks frames while recording, one copy per run of frames."""
+        for run in runs:
+            self.recBuffer.write(run.getImages())
+            if not run.isValid():
+                self.nOverwritten += run.countInvalid()
+
+    def startRecording(self, nFrames, scratchDir=None):
+        """ Starts storing frames in a new recording buffer of nFrames
+        frames. A previous buffer is left to the garbage collector since the
+        acquisition thread may still be writing to it."""
+        self.recBuffer = buffers.RecordingBuffer(
+            (self.orcaflash.frame_x, self.orcaflash.frame_y), nFrames,
+            scratchDir=scratchDir)
+        self.nOverwritten = 0
         self.recording = True
-        self.fRecorded.clear()
+        self.subscribe(self.record)
 
     def stopRecording(self):
+        self.unsubscribe(self.record)
         self.recording = False
 
 
@@ -253,9 +275,17 @@ class TormentaGUI(QtGui.QMainWindow):
         self.currCamIdx = 0
         noImage = np.zeros(self.shapes[self.currCamIdx])
         self.latest_images = [noImage] * len(self.cameras)
+        # Number of frames acquired by each camera when its latest image was
+        # published, consumers only recompute when it changes
+        self.latest_seqs = [0] * len(self.cameras)
+        # Statistics of the alignment tools' ROIs on every acquired frame
+        self.roiStats = [framestats.ROIStatsEngine(c) for c in self.cameras]
 
         self.s = Q_(1, 's')
-        self.lastTime = time.clock()
+        self.lastTime = ptime.time()
+        self.lastSeqs = list(self.latest_seqs)
+        self.shownVersion = None
+        self.nShown = 0
         self.fps = None
 
         # Actions and menubar
@@ -286,6 +316,12 @@ class TormentaGUI(QtGui.QMainWindow):
         self.exportTiffAction.triggered.connect(guitools.TiffConverterThread)
         fileMenu.addAction(self.exportTiffAction)
 
+        self.convertRawAction = QtGui.QAction('Convert raw to HDF5...', self)
+        self.convertRawAction.setStatusTip('Convert raw recordings to HDF5 '
+                                           'format')
+        self.convertRawAction.triggered.connect(self.convertRaw)
+        fileMenu.addAction(self.convertRawAction)
+
         self.exportlastAction = QtGui.QAction('Export last recording to Tiff',
                                               self)
         self.exportlastAction.setEnabled(False)
@@ -415,6 +451,8 @@ class TormentaGUI(QtGui.QMainWindow):
         self.statusBar().addPermanentWidget(self.cursorPos)
         self.cursorPosInt = QtGui.QLabel('0 counts', self)
         self.statusBar().addPermanentWidget(self.cursorPosInt)
+        self.saturationBox = QtGui.QLabel()
+        self.statusBar().addPermanentWidget(self.saturationBox)
 
         # Recording settings widget
         self.recWidget = record.RecordingWidget(self)
@@ -429,6 +467,9 @@ class TormentaGUI(QtGui.QMainWindow):
         self.vb.setAspectLocked(True)
         imageWidget.setAspectLocked(True)
         self.hist = pg.HistogramLUTItem(image=self.img)
+        # The histogram comes from the histogram service of the camera, not
+        # from every image set
+        self.img.sigImageChanged.disconnect(self.hist.imageChanged)
         self.hist.vb.setLimits(yMin=0, yMax=66000)
         self.cubehelixCM = pg.ColorMap(np.arange(0, 1, 1/256),
                                        guitools.cubehelix().astype(int))
@@ -583,7 +624,15 @@ class TormentaGUI(QtGui.QMainWindow):
         layout.setColumnMinimumWidth(2, 1350)
 
     def autoLevels(self):
-        self.hist.setLevels(*guitools.bestLimits(self.img.image))
+        if self.liveviewButton.isChecked():
+            # The levels are kept until there is a histogram to set them
+            histogram = self.histograms[self.currCamIdx]
+            if histogram.version == 0:
+                return
+            levels = histogram.bestLimits()
+        else:
+            levels = guitools.bestLimits(self.img.image)
+        self.hist.setLevels(*levels)
         self.hist.vb.autoRange()
 
     def toggleCamera(self):
@@ -610,6 +659,9 @@ class TormentaGUI(QtGui.QMainWindow):
             except AttributeError:
                 pass
 
+    def convertRaw(self):
+        self.rawConverterThread = guitools.RawConverterThread()
+
     def changeParameter(self, function):
         """ This method is used to change those camera properties that need
         the camera to be idle to be able to be adjusted.
@@ -643,9 +695,9 @@ class TormentaGUI(QtGui.QMainWindow):
                 lambda: self.cameras[self.currCamIdx].setPropertyValue(
                     'trigger_mode', 1))
 
-    def updateLevels(self, image):
-        std = np.std(image)
-        self.hist.setLevels(np.min(image) - std, np.max(image) + std)
+    def updateLevels(self):
+        low, high, mean, std = self.histograms[self.currCamIdx].stats()
+        self.hist.setLevels(low - std, high + std)
 
     def setBinning(self):
         """Method to change the binning of the captured frame."""
@@ -674,13 +726,6 @@ class TormentaGUI(QtGui.QMainWindow):
 
     def cropOrca(self, hpos, vpos, hsize, vsize):
         """Method to crop the frame read out by Orcaflash. """
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_vpos', 0)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_hpos', 0)
-        self.cameras[self.currCamIdx].setPropertyValue(
-            'subarray_vsize', 2048)
-        self.cameras[self.currCamIdx].setPropertyValue(
-            'subarray_hsize', 2048)
-
         # Round to closest "divisable by 4" value.
 #        vpos = int(4 * np.ceil(vpos / 4))
 #        hpos = int(4 * np.ceil(hpos / 4))
@@ -694,10 +739,11 @@ class TormentaGUI(QtGui.QMainWindow):
         vsize = int(min(2048 - vpos, minroi * np.ceil(vsize / minroi)))
         hsize = int(min(2048 - hpos, minroi * np.ceil(hsize / minroi)))
 
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_vsize', vsize)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_hsize', hsize)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_vpos', vpos)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_hpos', hpos)
+        # Only the values that changed are sent, in an order the camera
+        # accepts.
+        self.cameras[self.currCamIdx].setPropertyValues(
+            [('subarray_hpos', hpos), ('subarray_hsize', hsize),
+             ('subarray_vpos', vpos), ('subarray_vsize', vsize)])
 
         # This should be the only place where self.frameStart is changed
         self.frameStart = (hpos, vpos)
@@ -859,12 +905,11 @@ class TormentaGUI(QtGui.QMainWindow):
             self.liveviewStop()
 
     def liveviewStart(self):
-        ''' Threading below  is done in this way since making LVThread a
-        QThread resulted in QTimer not functioning in the thread. Image is now
-        also saved as latest_image in TormentaGUI class since setting image in
-        GUI from thread results in issues when interacting with the viewbox
-        from GUI. Maybe due to simultaneous manipulation of viewbox from GUI
-        and thread.'''
+        ''' Each camera gets its own acquisition loop (LVWorker) running in a
+        QThread. Image is also saved as latest_image in TormentaGUI class
+        since setting image in GUI from thread results in issues when
+        interacting with the viewbox from GUI. Maybe due to simultaneous
+        manipulation of viewbox from GUI and thread.'''
 
         self.crosshairButton.setEnabled(True)
         self.gridButton.setEnabled(True)
@@ -873,26 +918,46 @@ class TormentaGUI(QtGui.QMainWindow):
 
         self.lvworkers = [None] * len(self.cameras)
         self.lvthreads = [None] * len(self.cameras)
+        # One histogram per frame for levels, LUT and saturation
+        self.histograms = [framestats.HistogramService()
+                           for c in self.cameras]
+        self.shownHistogram = None
+        self.levelsPending = True
 
         for i in np.arange(len(self.cameras)):
             self.lvworkers[i] = LVWorker(self, i, self.cameras[i])
+            self.lvworkers[i].subscribe(self.histograms[i].update)
+            self.lvworkers[i].subscribe(self.roiStats[i].update)
             self.lvthreads[i] = QtCore.QThread()
             self.lvworkers[i].moveToThread(self.lvthreads[i])
             self.lvthreads[i].started.connect(self.lvworkers[i].run)
             self.lvthreads[i].start()
             self.viewtimer.start(30)
 
+        # The image shown is built out of the GUI thread, reduced to the view
+        self.shownVersion = None
+        self.displayWorker = display.DisplayWorker(self)
+        self.displayThread = QtCore.QThread()
+        self.displayWorker.moveToThread(self.displayThread)
+        self.displayThread.started.connect(self.displayWorker.run)
+        self.displayThread.start()
+
         self.liveviewRun()
 
     def liveviewStop(self):
 
         for i in np.arange(len(self.cameras)):
             self.lvworkers[i].stop()
-            self.lvthreads[i].terminate()
             # Turn off camera, close shutter
             self.cameras[i].stopAcquisition()
+            # The loop ends within one wait timeout
+            self.lvthreads[i].quit()
+            self.lvthreads[i].wait()
 
         self.viewtimer.stop()
+        self.displayWorker.stop()
+        self.displayThread.quit()
+        self.displayThread.wait()
 
         if self.crosshair.showed:
             self.crosshair.hide()
@@ -905,14 +970,16 @@ class TormentaGUI(QtGui.QMainWindow):
         self.recWidget.readyToRecord = False
 
         self.vb.scene().sigMouseMoved.disconnect()
-        self.img.setImage(
-            np.zeros(self.shapes[self.currCamIdx]), autoLevels=False)
+        shape = self.shapes[self.currCamIdx]
+        self.img.setImage(np.zeros(shape), autoLevels=False)
+        self.img.setRect(QtCore.QRectF(-0.5, -0.5, *shape))
 
     def liveviewRun(self):
         self.vb.scene().sigMouseMoved.connect(self.mouseMoved)
         for i in np.arange(len(self.cameras)):
             # Needed if parameter is changed during liveview since that causes
             # camera to start writing to buffer place zero again.
+            self.roiStats[i].restart()
             self.cameras[i].startAcquisition()
 
     def liveviewPause(self):
@@ -920,10 +987,31 @@ class TormentaGUI(QtGui.QMainWindow):
             c.stopAcquisition()
 
     def updateView(self):
-        """ Image update while in Liveview mode
+        """ Image update while in Liveview mode, with the image reduced to
+        the view by the display worker.
         """
-        self.img.setImage(self.latest_images[self.currCamIdx],
-                          autoLevels=False, autoDownsample=False)
+        self.displayWorker.setView(self.vb.viewRect(), self.vb.width(),
+                                   self.vb.height())
+        # Only new images are uploaded
+        version = self.displayWorker.version
+        if version != self.shownVersion and version > 0:
+            image, (x, y, width, height) = self.displayWorker.result
+            self.img.setImage(image, autoLevels=False, autoDownsample=False)
+            self.img.setRect(QtCore.QRectF(x - 0.5, y - 0.5, width, height))
+            self.shownVersion = version
+            self.nShown += 1
+
+        histogram = self.histograms[self.currCamIdx]
+        version = (self.currCamIdx, histogram.version)
+        if version != self.shownHistogram and histogram.version > 0:
+            # First frame only to set suitable histogram limits
+            if self.levelsPending:
+                self.autoLevels()
+                self.levelsPending = False
+            edges, counts = histogram.binned()
+            self.hist.plot.setData(edges[:-1], counts)
+            self.shownHistogram = version
+        self.fpsMath()
         if self.alignmentON:
             if self.alignmentCheck.isChecked():
                 self.vb.addItem(self.alignmentLine)
@@ -949,23 +1037,38 @@ class TormentaGUI(QtGui.QMainWindow):
         self.alignmentON = True
 
     def fpsMath(self):
+        """ Rates of the images shown and of the frames acquired by the
+        current camera, every half a second."""
         now = ptime.time()
         dt = now - self.lastTime
+        if dt < 0.5:
+            return
+        seq = self.latest_seqs[self.currCamIdx]
+        self.fps = self.nShown / dt
+        acqFps = (seq - self.lastSeqs[self.currCamIdx]) / dt
         self.lastTime = now
-        if self.fps is None:
-            self.fps = 1.0 / dt
-        else:
-            s = np.clip(dt * 3., 0, 1)
-            self.fps = self.fps * (1 - s) + (1.0 / dt) * s
-        self.fpsBox.setText('{} fps'.format(int(self.fps)))
+        self.lastSeqs = list(self.latest_seqs)
+        self.nShown = 0
+        self.fpsBox.setText('{} fps display / {} fps acquisition'.format(
+            int(self.fps), int(acqFps)))
+        saturated = self.histograms[self.currCamIdx].saturated()
+        self.saturationBox.setText('{:.2f}% saturated'.format(100*saturated))
 
     def closeEvent(self, *args, **kwargs):
 
         # Stop running threads
         self.viewtimer.stop()
         try:
-            for thread in self.lvthreads:
-                thread.terminate()
+            self.displayWorker.stop()
+            self.displayThread.quit()
+            self.displayThread.wait()
+        except AttributeError:
+            pass
+        try:
+            for worker, thread in zip(self.lvworkers, self.lvthreads):
+                worker.running = False
+                thread.quit()
+                thread.wait()
         except BaseException:
             pass
 
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:40:12 2026
+
+@author: Tempesta_team
+"""
+import time
+
+import numpy as np
+
+from pyqtgraph.Qt import QtCore
+
+
+def levelOfDetail(image, view, pixels, mode='max'):
+    """ Part of image inside view, (x0, y0, x1, y1) in image coordinates,
+    reduced by an integer factor so that it has about as many pixels as the
+    screen area showing it, pixels (width, height). The reduction keeps the
+    maximum of each block ('max', so that single bright spots stay
+    visible), their 'mean' or just 'subsample's. Returns the array and the
+    (x, y, width, height) rectangle of image it covers."""
+    nx, ny = image.shape[:2]
+    x0 = int(np.clip(np.floor(view[0]), 0, nx - 1))
+    y0 = int(np.clip(np.floor(view[1]), 0, ny - 1))
+    x1 = int(np.clip(np.ceil(view[2]) + 1, x0 + 1, nx))
+    y1 = int(np.clip(np.ceil(view[3]) + 1, y0 + 1, ny))
+    crop = image[x0:x1, y0:y1]
+
+    # Same factor on both axes, so that pixels stay square
+    k = int(np.ceil(max(crop.shape[0] / max(1, pixels[0]),
+                        crop.shape[1] / max(1, pixels[1]))))
+    if k <= 1:
+        return crop, (x0, y0, crop.shape[0], crop.shape[1])
+
+    w, h = max(1, crop.shape[0] // k), max(1, crop.shape[1] // k)
+    if mode == 'subsample':
+        reduced = crop[:w*k:k, :h*k:k]
+    else:
+        blocks = crop[:w*k, :h*k].reshape(w, k, h, k)
+        if mode == 'mean':
+            reduced = blocks.mean(axis=(1, 3))
+        else:
+            reduced = blocks.max(axis=(1, 3))
+    return reduced, (x0, y0, w*k, h*k)
+
+
+class DisplayWorker(QtCore.QObject):
+    """ Builds the image the liveview shows out of the GUI thread: the
+    latest frame of the current camera reduced to the view (see
+    levelOfDetail), at most every interval seconds and only when the frame
+    or the view changed. The GUI sets the view with setView and picks the
+    result, an (image, rect) pair, from the result attribute whenever
+    version, the number of results built, changes."""
+
+    def __init__(self, main, interval=0.02, mode='max', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.main = main
+        self.interval = interval
+        self.mode = mode
+        self.running = False
+        self.view = None        # ((x0, y0, x1, y1), (width, height))
+        self.result = None
+        self.version = 0
+        self.lastFrame = None   # (camera, sequence number) of the result
+        self.lastView = None
+
+    def setView(self, rect, width, height, margin=0.25):
+        """ Visible rectangle of the viewbox, in image coordinates, and its
+        size on screen, in pixels. A margin (fraction of the view) around it
+        is rendered as well, so that panning shows no blank borders while
+        the next image is built."""
+        dx, dy = margin * rect.width(), margin * rect.height()
+        self.view = ((rect.left() - dx, rect.top() - dy,
+                      rect.right() + dx, rect.bottom() + dy),
+                     ((1 + 2*margin) * width, (1 + 2*margin) * height))
+
+    def run(self):
+        self.running = True
+        while self.running:
+            ind = self.main.currCamIdx
+            frame = (ind, self.main.latest_seqs[ind])
+            image = self.main.latest_images[ind]
+            view = self.view
+            if view is not None and (frame != self.lastFrame or
+                                     view != self.lastView):
+                self.result = levelOfDetail(image, view[0], view[1],
+                                            self.mode)
+                self.version += 1
+                self.lastFrame = frame
+                self.lastView = view
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:21:37 2026
+
+@author: Tempesta_team
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import numpy as np
+
+
+def limitsFromHistogram(hist, edges, pixelCount):
+    """ Best cmin, cmax from a 256 bin histogram, as ImageJ's automatic
+    brightness/contrast: the first and last bins with more than
+    pixelCount/5000 counts, ignoring those with more than pixelCount/10."""
+    limit = pixelCount/10
+    threshold = pixelCount/5000
+    found = (hist > threshold) & (hist <= limit)
+    low = np.flatnonzero(found[1:])
+    high = np.flatnonzero(found)
+    hmin = low[0] + 1 if len(low) > 0 else len(hist) - 1
+    hmax = high[-1] if len(high) > 0 else 0
+    return edges[hmin], edges[hmax]
+
+
+class HistogramService(object):
+    """ Histogram of the frames of a camera, shared by auto-levels, the LUT
+    widget and the saturation statistics instead of each one computing its
+    own over the whole frame.
+
+    update is subscribed to the camera's LVWorker, so the histogram of the
+    latest published frame is computed in the acquisition thread, at most
+    every interval seconds. It is a bincount of the uint16 values of every
+    stride-th pixel along each axis. With smoothing (between 0 and 1) it is
+    an exponential average over frames instead. version counts the
+    histograms computed, so readers know when there is a new one."""
+
+    def __init__(self, stride=4, smoothing=None, saturation=65535,
+                 interval=0.03):
+        self.stride = stride
+        self.smoothing = smoothing
+        self.saturation = saturation
+        self.interval = interval
+        self.counts = None
+        self.version = 0
+        self.lastTime = 0
+
+    def update(self, runs):
+        now = time.perf_counter()
+        if now - self.lastTime >= self.interval:
+            self.lastTime = now
+            self.compute(runs[-1].getImage())
+
+    def compute(self, image):
+        sample = image[::self.stride, ::self.stride]
+        counts = np.bincount(sample.ravel(), minlength=65536).astype(float)
+        previous = self.counts
+        if self.smoothing is not None and previous is not None:
+            counts = (self.smoothing * counts +
+                      (1 - self.smoothing) * previous)
+        # Replaced, never changed in place, readers can keep a reference
+        self.counts = counts
+        self.version += 1
+
+    def range(self, counts):
+        values = np.flatnonzero(counts)
+        return values[0], values[-1]
+
+    def binned(self, nBins=256):
+        """ (edges, counts) of the histogram in nBins bins between the
+        smallest and the largest value, as np.histogram would give them."""
+        counts = self.counts
+        if counts is None:
+            return np.arange(nBins + 1), np.zeros(nBins)
+        low, high = self.range(counts)
+        edges = np.linspace(low, max(high, low + 1), nBins + 1)
+        values = np.arange(low, high + 1)
+        bins = np.minimum(
+            ((values - low) * nBins // max(1, high - low)), nBins - 1)
+        binned = np.bincount(bins, weights=counts[low:high + 1],
+                             minlength=nBins)
+        return edges, binned
+
+    def bestLimits(self):
+        """ Levels for the image, see limitsFromHistogram."""
+        edges, binned = self.binned()
+        return limitsFromHistogram(binned, edges, binned.sum())
+
+    def stats(self):
+        """ Minimum, maximum, mean and standard deviation of the values."""
+        counts = self.counts
+        if counts is None:
+            return 0, 0, 0, 0
+        low, high = self.range(counts)
+        values = np.arange(65536)
+        n = counts.sum()
+        mean = np.dot(values, counts) / n
+        std = np.sqrt(np.dot((values - mean)**2, counts) / n)
+        return low, high, mean, std
+
+    def saturated(self):
+        """ Fraction of the pixels at or above the saturation value."""
+        counts = self.counts
+        if counts is None:
+            return 0
+        return counts[self.saturation:].sum() / counts.sum()
+
+
+class RingSeries(object):
+    """ The last length values of some named quantities, 'time' among them,
+    in ring buffers. The writer appends whole arrays of values and only then
+    moves the count, so readers get consistent values in order with get."""
+
+    def __init__(self, names, length=10000):
+        self.length = length
+        self.data = {name: np.zeros(length) for name in ('time',) + names}
+        self.count = 0
+
+    def append(self, **values):
+        n = len(values['time'])
+        skip = max(0, n - self.length)
+        index = (self.count + np.arange(skip, n)) % self.length
+        for name, value in values.items():
+            self.data[name][index] = value[skip:]
+        self.count += n
+
+    def get(self, *names):
+        """ Values of each of names, oldest first, all of the same frames."""
+        count = self.count
+        n = min(count, self.length)
+        index = (count - n + np.arange(n)) % self.length
+        return [self.data[name][index] for name in names]
+
+    def reset(self):
+        self.count = 0
+
+
+class ROIStatsEngine(object):
+    """ Statistics of any number of rectangular ROIs of a camera on every
+    acquired frame, for the alignment tools.
+
+    update is subscribed to the camera's LVWorker, so all the frames of each
+    run are reduced at once, in the acquisition thread, by slicing the
+    (n, x, y) stack. For each ROI the mean, sum and max of every frame are
+    appended to a RingSeries, with the time of each frame, and with
+    projections the mean of the run along x and along y is kept as well.
+    The camera stamps a whole transfer with one host time, so frame times
+    are spread by frame number between consecutive transfers (see
+    frameTimes).
+    Widgets only render the results. The ROIs are replaced, never changed
+    in place, so that they can be set while frames are being reduced."""
+
+    def __init__(self, camera=None, length=10000):
+        self.camera = camera
+        self.length = length
+        self.rois = {}
+        self.lastNumber = None  # newest frame number and time seen
+        self.lastTime = None
+
+    def setROI(self, key, x, y, width, height, projections=False):
+        """ Adds the ROI key, or moves it keeping its series."""
+        roi = self.rois.get(key)
+        series = RingSeries(('mean', 'sum', 'max'), self.length)
+        if roi is not None:
+            series = roi['series']
+        rois = dict(self.rois)
+        rois[key] = {'bounds': (max(0, int(x)), max(0, int(y)),
+                                max(0, int(x + width)),
+                                max(0, int(y + height))),
+                     'projections': projections, 'series': series,
+                     'xProjection': None, 'yProjection': None}
+        self.rois = rois
+
+    def removeROI(self, key):
+        self.rois = {k: roi for k, roi in self.rois.items() if k != key}
+
+    def series(self, key):
+        roi = self.rois.get(key)
+        return None if roi is None else roi['series']
+
+    def projection(self, key, axis):
+        """ Mean of the last run of frames of the ROI along axis (0: x, as
+        np.mean(image, 0), or 1: y), None until there is one."""
+        roi = self.rois.get(key)
+        if roi is None:
+            return None
+        return roi['xProjection'] if axis == 0 else roi['yProjection']
+
+    def restart(self):
+        """ Frame numbers start over with a new acquisition."""
+        self.lastNumber = None
+        self.lastTime = None
+
+    def frameTimes(self, runs):
+        """ Host time of each frame of the runs of one transfer, a list with
+        an array per run. The newest frame has the timestamp of the
+        transfer, the others are before it at the frame period since the
+        previous transfer, or, for the first transfer of an acquisition, at
+        the camera's frame interval."""
+        lengths = [len(run) for run in runs]
+        if any(run.metadata is None for run in runs):
+            return [np.full(n, time.perf_counter()) for n in lengths]
+        metadata = np.concatenate([run.metadata for run in runs])
+        numbers = metadata['frame_number']
+        stamp = float(metadata['timestamp'][-1])
+        newest = int(numbers[-1])
+        # Numbers only grow within an acquisition
+        if self.lastNumber is not None and int(numbers[0]) > self.lastNumber:
+            period = (stamp - self.lastTime) / (newest - self.lastNumber)
+        elif self.camera is not None:
+            period = self.camera.getPropertyValue(
+                'internal_frame_interval')[0]
+        else:
+            period = 0
+        self.lastNumber = newest
+        self.lastTime = stamp
+        times = stamp - (newest - numbers) * period
+        return np.split(times, np.cumsum(lengths)[:-1])
+
+    def update(self, runs):
+        rois = self.rois
+        # Followed even without ROIs, so that new ones get good times
+        allTimes = self.frameTimes(runs)
+        if len(rois) == 0:
+            return
+        for run, times in zip(runs, allTimes):
+            images = run.getImages()
+            for roi in rois.values():
+                x0, y0, x1, y1 = roi['bounds']
+                region = images[:, x0:x1, y0:y1]
+                if region.size == 0:
+                    continue
+                roi['series'].append(time=times,
+                                     mean=region.mean(axis=(1, 2)),
+                                     sum=region.sum(axis=(1, 2)),
+                                     max=region.max(axis=(1, 2)))
+                if roi['projections']:
+                    roi['xProjection'] = region.mean(axis=(0, 1))
+                    roi['yProjection'] = region.mean(axis=(0, 2))
+
+
+class SpectrumService(object):
+    """ Running average of the power spectrum of a square, power of two,
+    crop of the frames of a camera, for the FFT alignment tool.
+
+    update is subscribed to the camera's LVWorker. The newest frames of each
+    run are cropped and multiplied by the apodization window in the
+    acquisition thread, into one of a pool of preallocated buffers, and their
+    real FFTs (rfft2) are computed by worker threads. Frames that arrive
+    while all the workers are busy are skipped. Each power spectrum is added
+    to an exponential average with weight averaging (1 shows only the last
+    one). version counts the spectra averaged, so readers know when there is
+    a new one."""
+
+    def __init__(self, size=256, window='hanning', averaging=0.2, workers=2):
+        self.window = window
+        self.averaging = averaging
+        self.workers = workers
+        self.windows = {}       # cached apodization windows, by size
+        self.lock = threading.RLock()
+        self.executor = None
+        self.crop = None
+        self.generation = 0     # of the buffers, one per average
+        self.setCrop(size)
+
+    def setCrop(self, size, center=None):
+        """ Crop of size x size pixels centered on center, (x, y) in image
+        coordinates, or on the middle of the frames. A new size starts a new
+        average."""
+        crop = (int(size), center)
+        if crop == self.crop:
+            return
+        with self.lock:
+            if self.crop is None or crop[0] != self.crop[0]:
+                self.reset()
+            self.crop = crop
+
+    def reset(self):
+        """ Starts a new average."""
+        with self.lock:
+            # Buffers still being transformed belong to the old average,
+            # they and their spectra are dropped
+            self.generation += 1
+            self.free = []
+            self.allocated = 0
+            self.average = None
+            self.count = 0
+            self.version = 0
+
+    def apodization(self, size):
+        if size not in self.windows:
+            if self.window is None:
+                line = np.ones(size)
+            else:
+                line = getattr(np, self.window)(size)
+            self.windows[size] = np.outer(line, line).astype(np.float32)
+        return self.windows[size]
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers)
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def update(self, runs):
+        if self.executor is None:
+            return
+        for run in reversed(runs):
+            images = run.getImages()
+            for i in range(len(images) - 1, -1, -1):
+                if not self.submit(images[i]):
+                    return
+
+    def submit(self, image):
+        """ Queues the transform of image, False if it can not be done."""
+        size, center = self.crop
+        nx, ny = image.shape
+        if nx < size or ny < size:
+            return False
+        if center is None:
+            center = (nx / 2, ny / 2)
+        x0 = int(np.clip(center[0] - size // 2, 0, nx - size))
+        y0 = int(np.clip(center[1] - size // 2, 0, ny - size))
+
+        with self.lock:
+            if size != self.crop[0]:
+                return False
+            if len(self.free) > 0:
+                buffer = self.free.pop()
+            elif self.allocated < self.workers:
+                buffer = np.empty((size, size), dtype=np.float32)
+                self.allocated += 1
+            else:
+                return False
+            generation = self.generation
+        np.multiply(image[x0:x0 + size, y0:y0 + size],
+                    self.apodization(size), out=buffer)
+        executor = self.executor
+        if executor is None:
+            self.giveBack(buffer, generation)
+            return False
+        executor.submit(self.transform, buffer, generation)
+        return True
+
+    def giveBack(self, buffer, generation):
+        """ Returns buffer to the pool, if it is of the current average."""
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.free.append(buffer)
+            return True
+
+    def transform(self, buffer, generation):
+        spectrum = np.fft.rfft2(buffer)
+        power = spectrum.real**2 + spectrum.imag**2
+        with self.lock:
+            if not self.giveBack(buffer, generation):
+                return
+            if self.average is None:
+                self.average = power
+            else:
+                self.average *= 1 - self.averaging
+                self.average += self.averaging * power
+            self.count += 1
+            self.version += 1
+
+    def spectrum(self):
+        """ Averaged power spectrum of the whole frequency plane, with the
+        zero frequency in the middle as np.fft.fftshift puts it, None until
+        there is one."""
+        with self.lock:
+            if self.average is None:
+                return None
+            half = self.average.copy()
+        # The spectrum of a real image is symmetric, P(-k) = P(k)
+        n = len(half)
+        full = np.empty((n, n))
+        full[:, :half.shape[1]] = half
+        rows = -np.arange(n) % n
+        columns = n - np.arange(half.shape[1], n)
+        full[:, half.shape[1]:] = half[rows][:, columns]
+        return np.fft.fftshift(full)
@@ -23,6 +23,9 @@ from tkinter import Tk, filedialog, simpledialog
 
 from lantz import Q_
 
+import control.writers as writers
+import control.framestats as framestats
+
 
 # taken from https://www.mrao.cam.ac.uk/~dag/CUBEHELIX/cubehelix.py
 def cubehelix(gamma=1.0, s=0.5, r=-1.5, h=1.0):
@@ -194,35 +197,9 @@ def bestLimits(arr):
     # Best cmin, cmax algorithm taken from ImageJ routine:
     # http://cmci.embl.de/documents/120206pyip_cooking/
     # python_imagej_cookbook#automatic_brightnesscontrast_button
-    pixelCount = arr.size
-    limit = pixelCount/10
-    threshold = pixelCount/5000
+    # The liveview uses the histograms of framestats.HistogramService
     hist, bin_edges = np.histogram(arr, 256)
-    i = 0
-    found = False
-    count = 0
-    while True:
-        i += 1
-        count = hist[i]
-        if count > limit:
-            count = 0
-        found = count > threshold
-        if found or i >= 255:
-            break
-    hmin = i
-
-    i = 256
-    while True:
-        i -= 1
-        count = hist[i]
-        if count > limit:
-            count = 0
-        found = count > threshold
-        if found or i < 1:
-            break
-    hmax = i
-
-    return bin_edges[hmin], bin_edges[hmax]
+    return framestats.limitsFromHistogram(hist, bin_edges, arr.size)
 
 
 def cmapToColormap(cmap, nTicks=16):
@@ -354,6 +331,9 @@ class TiffConverter(QtCore.QObject):
                 file = hdf.File(filename, mode='r')
 
                 for dataname in file:
+                    # Frame bookkeeping of the recordings, not images
+                    if dataname in ['FrameMetadata', 'FrameCount']:
+                        continue
 
                     data = file[dataname]
                     filesize = fileSizeGB(data.shape)
@@ -391,6 +371,42 @@ class TiffConverter(QtCore.QObject):
         #                open('/Path/filename.txt'))
 
 
+class RawConverterThread(QtCore.QThread):
+    ''' Converts raw recordings (see writers.RawFrameWriter) to saveMode in
+    the background, asking for the files if none are given.'''
+
+    def __init__(self, filenames=None, saveMode='hdf5'):
+        super().__init__()
+
+        self.converter = RawConverter(filenames, saveMode, self)
+        self.converter.moveToThread(self)
+        self.started.connect(self.converter.run)
+        self.start()
+
+
+class RawConverter(QtCore.QObject):
+
+    def __init__(self, filenames, saveMode, thread, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filenames = filenames
+        self.saveMode = saveMode
+        self.thread = thread
+
+    def run(self):
+
+        if self.filenames is None:
+            self.filenames = getFilenames("Select raw recordings",
+                                          [('Raw files', '.raw')])
+
+        if self.filenames is not None and len(self.filenames) > 0:
+            for filename in self.filenames:
+                writers.convertRaw(filename, self.saveMode)
+
+            print(self.filenames, 'converted to', self.saveMode)
+        self.filenames = None
+        self.thread.terminate()
+
+
 class Grid():
 
     def __init__(self, viewBox):
@@ -577,6 +593,20 @@ class ROI(pg.ROI):
         super().show(*args, **kwargs)
         self.label.show()
 
+    def region(self, image):
+        """ Part of a full frame under the ROI. Frames are not necessarily
+        shown at full resolution (see display.levelOfDetail), so the ROI is
+        mapped through its position in image coordinates, not through the
+        ImageItem."""
+        x0, y0, width, height = self.bounds()
+        return image[x0:x0 + width, y0:y0 + height]
+
+    def bounds(self):
+        """ (x, y, width, height) of the ROI in image pixels."""
+        x0, y0 = np.round(self.pos()).astype(int)
+        width, height = np.round(self.size()).astype(int)
+        return max(0, x0), max(0, y0), max(1, width), max(1, height)
+
 
 class cropROI(pg.ROI):
 
@@ -603,6 +633,7 @@ class AlignWidgetAverage(QtGui.QFrame):
                        scaleSnap=True, translateSnap=True)
 
         self.ROI.hide()
+        self.ROI.sigRegionChanged.connect(self.setROI)
         self.graph = SumpixelsGraph()
         self.roiButton = QtGui.QPushButton('Show ROI')
         self.roiButton.setCheckable(True)
@@ -622,33 +653,52 @@ class AlignWidgetAverage(QtGui.QFrame):
         self.alignTimer = QtCore.QTimer()
         self.alignTimer.timeout.connect(self.updateValue)
 #        self.alignTimer.start(self.alignTime)
+        self.lastCount = None
 
     def resetGraph(self):
+        # A new ROI starts new series
+        if self.roiButton.isChecked():
+            self.removeROI()
+            self.setROI()
         self.graph.resetData()
 
+    def setROI(self):
+        """ Has the ROI statistics engines of all cameras follow the ROI, the
+        statistics of every frame inside it are computed as frames arrive."""
+        if self.roiButton.isChecked():
+            for engine in self.main.roiStats:
+                engine.setROI(self, *self.ROI.bounds())
+
+    def removeROI(self):
+        for engine in self.main.roiStats:
+            engine.removeROI(self)
+
     def ROItoggle(self):
         if self.roiButton.isChecked() is False:
             self.ROI.hide()
             self.alignTimer.stop()
+            self.removeROI()
             self.roiButton.setText('Show ROI')
         else:
             self.ROI.show()
             self.roiButton.setText('Hide ROI')
+            self.setROI()
             self.alignTimer.start(self.alignTime)
 
     def updateValue(self):
 
-        if self.main.liveviewButton.isChecked():
-            self.selected = self.ROI.getArrayRegion(
-                self.main.latest_images[self.main.currCamIdx], self.main.img)
-            value = np.mean(self.selected)
-            self.graph.updateGraph(value)
-        else:
-            pass
+        # Nothing to do until new frames were reduced
+        ind = self.main.currCamIdx
+        series = self.main.roiStats[ind].series(self)
+        if series is None or (ind, series.count) == self.lastCount:
+            return
+        self.lastCount = (ind, series.count)
+        self.graph.updateGraph(series)
 
     def closeEvent(self, *args, **kwargs):
 
         self.alignTimer.stop()
+        self.removeROI()
 
         super().closeEvent(*args, **kwargs)
 
@@ -661,10 +711,6 @@ class SumpixelsGraph(pg.GraphicsWindow):
         self.setWindowTitle('Average of area')
         self.setAntialiasing(True)
 
-        self.npoints = 400
-        self.data = np.zeros(self.npoints)
-        self.ptr = 0
-
         # Graph without a fixed range
         self.statistics = pg.LabelItem(justify='right')
         self.addItem(self.statistics)
@@ -674,35 +720,26 @@ class SumpixelsGraph(pg.GraphicsWindow):
         self.plot.showGrid(x=True, y=True)
         self.sumCurve = self.plot.plot(pen='y')
 
-        self.time = np.zeros(self.npoints)
-        self.startTime = ptime.time()
+        self.startTime = None
 
     def resetData(self):
-        """Set all data points to zero, useful if going from very large values
+        """Start the time axis again, useful if going from very large values
         to very small values"""
-        self.data = np.zeros(self.npoints)
-        self.time = np.zeros(self.npoints)
-        self.startTime = ptime.time()
-        self.ptr = 0
-
-    def updateGraph(self, value):
-        """ Update the data displayed in the graphs
-        """
-        if self.ptr < self.npoints:
-            self.data[self.ptr] = value
-            self.time[self.ptr] = ptime.time() - self.startTime
-            self.sumCurve.setData(self.time[1:self.ptr + 1],
-                                  self.data[1:self.ptr + 1])
-
-        else:
-            self.data[:-1] = self.data[1:]
-            self.data[-1] = value
-            self.time[:-1] = self.time[1:]
-            self.time[-1] = ptime.time() - self.startTime
-
-            self.sumCurve.setData(self.time, self.data)
+        self.startTime = None
+        self.sumCurve.setData([], [])
+        self.statistics.setText('---')
 
-        self.ptr += 1
+    def updateGraph(self, series):
+        """ Plots the mean of the ROI in every frame of series, a
+        framestats.RingSeries, against the time of the frames."""
+        times, means, sums, maxima = series.get('time', 'mean', 'sum', 'max')
+        if len(times) == 0:
+            return
+        if self.startTime is None:
+            self.startTime = times[0]
+        self.sumCurve.setData(times - self.startTime, means)
+        self.statistics.setText('mean {:.1f}, sum {:.0f}, max {:.0f}'.format(
+            means[-1], sums[-1], maxima[-1]))
 
 
 class AlignWidgetXYProject(QtGui.QFrame):
@@ -718,6 +755,7 @@ class AlignWidgetXYProject(QtGui.QFrame):
                        scaleSnap=True, translateSnap=True)
 
         self.ROI.hide()
+        self.ROI.sigRegionChanged.connect(self.setROI)
         self.graph = ProjectionGraph()
         self.roiButton = QtGui.QPushButton('Show ROI')
         self.roiButton.setCheckable(True)
@@ -742,31 +780,50 @@ class AlignWidgetXYProject(QtGui.QFrame):
         # 2 zeros because it has to have the attribute "len"
         self.latest_values = np.zeros(2)
         self.s_fac = 0.3
+        self.lastFrame = None
+        self.lastProjection = None
 
     def resetGraph(self):
         self.graph.resetData()
 
+    def setROI(self):
+        """ The projections of the ROI, on the first camera, are computed by
+        its ROI statistics engine as frames arrive."""
+        if self.roiButton.isChecked():
+            self.main.roiStats[0].setROI(self, *self.ROI.bounds(),
+                                         projections=True)
+
     def ROItoggle(self):
         if self.roiButton.isChecked() is False:
             self.ROI.hide()
+            self.main.roiStats[0].removeROI(self)
             self.roiButton.setText('Show ROI')
         else:
             self.ROI.show()
             self.roiButton.setText('Hide ROI')
+            self.setROI()
 
     def updateValue(self):
 
-        if (self.main.liveviewButton.isChecked() and
-                self.roiButton.isChecked()):
-            self.selected = self.ROI.getArrayRegion(self.main.latest_images[0],
-                                                    self.main.img)
+        # Nothing to do until a new frame arrives or the ROI is toggled
+        roi = (self.main.liveviewButton.isChecked() and
+               self.roiButton.isChecked())
+        axis = 0 if self.Xradio.isChecked() else 1
+        if roi:
+            values = self.main.roiStats[0].projection(self, axis)
+            if values is None or values is self.lastProjection:
+                return
+            self.lastProjection = values
+            self.lastFrame = None
         else:
-            self.selected = self.main.latest_images[self.main.currCamIdx]
-
-        if self.Xradio.isChecked():
-            values = np.mean(self.selected, 0)
-        else:
-            values = np.mean(self.selected, 1)
+            ind = self.main.currCamIdx
+            frame = (ind, self.main.latest_seqs[ind], axis)
+            if frame == self.lastFrame:
+                return
+            self.lastFrame = frame
+            self.lastProjection = None
+            self.selected = self.main.latest_images[ind]
+            values = np.mean(self.selected, axis)
 
         if len(self.latest_values) == len(values):
             smoothed = self.s_fac*values + (1-self.s_fac)*self.latest_values
@@ -779,6 +836,7 @@ class AlignWidgetXYProject(QtGui.QFrame):
 
     def closeEvent(self, *args, **kwargs):
         self.alignTimer.stop()
+        self.main.roiStats[0].removeROI(self)
         super().closeEvent(*args, **kwargs)
 
 
@@ -820,15 +878,34 @@ class FFTWidget(QtGui.QFrame):
 
         self.main = main
         self.f = None #Variable where the future FFT is saved.
+        self.lastFrame = None   # (camera, sequence number) of the FFT
         # Do FFT button
         self.doButton = QtGui.QPushButton('Do FFT')
         self.doButton.clicked.connect(self.doFFT)
 
+        # Continuous FFT of a crop of the frames, as they are acquired
+        self.spectrum = framestats.SpectrumService()
+        self.worker = None      # LVWorker the spectrum is subscribed to
+        self.shownVersion = None
+        self.streamButton = QtGui.QPushButton('Stream FFT')
+        self.streamButton.setCheckable(True)
+        self.streamButton.clicked.connect(self.toggleStream)
+        self.sizeBox = QtGui.QComboBox()
+        self.sizeBox.addItems([str(2**n) for n in range(6, 12)])
+        self.sizeBox.setCurrentIndex(2)
+        self.sizeBox.setToolTip('Size of the crop, centered on the view')
+        self.averagingEdit = QtGui.QLineEdit('0.2')
+        self.averagingEdit.setToolTip('Weight of each new spectrum')
+        self.averagingEdit.editingFinished.connect(self.setAveraging)
+        self.streamTimer = QtCore.QTimer()
+        self.streamTimer.timeout.connect(self.updateStream)
+
         # Period button and text for changing the vertical lines
         self.changePosButton = QtGui.QPushButton('Period (pix)')
         self.changePosButton.clicked.connect(self.changePos)
 
         self.linePos = QtGui.QLineEdit('4')
+        self.period = 4.
 
         grid = QtGui.QGridLayout()
         self.setLayout(grid)
@@ -873,23 +950,41 @@ class FFTWidget(QtGui.QFrame):
 
         grid.addWidget(self.cwidget, 0, 0, 1, 6)
         grid.addWidget(self.doButton, 1, 0, 1, 1)
+        grid.addWidget(self.streamButton, 1, 1, 1, 1)
+        grid.addWidget(QtGui.QLabel('Crop (pix)'), 1, 2, 1, 1)
+        grid.addWidget(self.sizeBox, 1, 3, 1, 1)
+        grid.addWidget(QtGui.QLabel('Averaging'), 1, 4, 1, 1)
+        grid.addWidget(self.averagingEdit, 1, 5, 1, 1)
         grid.addWidget(self.changePosButton, 2, 0, 1, 1)
         grid.addWidget(self.linePos, 2, 1, 1, 1)
         grid.setRowMinimumHeight(0, 300)
 
         self.init = False
+        self.imgWidth = None
+        self.imgHeight = None
 
     def doFFT(self):
         " FFT of the latest camera image, centering (0, 0) in the middle with fftshift "
 
         autoL = self.f is None
 
+        # Same frame, same FFT
+        ind = self.main.currCamIdx
+        frame = (ind, self.main.latest_seqs[ind])
+        if frame == self.lastFrame:
+            return
+        self.lastFrame = frame
+
         self.f = np.fft.fftshift(np.log10(abs(np.fft.fft2(self.main.latest_images[self.main.currCamIdx]))))
+        self.showFFT(autoL)
 
-        self.img.setImage(self.f, autoLevels=autoL)
+    def showFFT(self, autoLevels):
+        self.img.setImage(self.f, autoLevels=autoLevels)
 
-        # By default F = 0.25, period of T = 4 pixels
-        pos = 0.25
+        # Limits and lines only change with the size of the FFT
+        if (self.img.width(), self.img.height()) == (self.imgWidth,
+                                                     self.imgHeight):
+            return
         self.imgWidth = self.img.width()
         self.imgHeight = self.img.height()
         self.vb.setAspectLocked()
@@ -899,25 +994,72 @@ class FFTWidget(QtGui.QFrame):
         self.vline.setValue(0.5*self.imgWidth)
         self.hline.setAngle(0)
         self.hline.setValue(0.5*self.imgHeight)
-        self.rvline.setValue((0.5+pos)*self.imgWidth)
-        self.lvline.setValue((0.5-pos)*self.imgWidth)
-        self.dhline.setAngle(0)
-        self.dhline.setValue((0.5-pos)*self.imgHeight)
-        self.uhline.setAngle(0)
-        self.uhline.setValue((0.5+pos)*self.imgHeight)
+        self.setLines()
+
+    def toggleStream(self):
+        """ Streams the FFT of a crop of the frames of the current camera,
+        centered on the liveview, while the liveview runs."""
+        if self.streamButton.isChecked():
+            if not self.main.liveviewButton.isChecked():
+                self.streamButton.setChecked(False)
+                return
+            self.setAveraging()
+            self.spectrum.start()
+            self.streamTimer.start(50)
+        else:
+            self.stopStream()
+
+    def stopStream(self):
+        self.streamTimer.stop()
+        if self.worker is not None:
+            self.worker.unsubscribe(self.spectrum.update)
+            self.worker = None
+        self.spectrum.stop()
+
+    def setAveraging(self):
+        try:
+            averaging = float(self.averagingEdit.text())
+        except ValueError:
+            return
+        self.spectrum.averaging = min(1, max(averaging, 1e-3))
+
+    def updateStream(self):
+        if not self.main.liveviewButton.isChecked():
+            self.streamButton.setChecked(False)
+            self.stopStream()
+            return
+
+        # New LVWorkers when the liveview restarts, or another camera
+        worker = self.main.lvworkers[self.main.currCamIdx]
+        if worker is not self.worker:
+            if self.worker is not None:
+                self.worker.unsubscribe(self.spectrum.update)
+            worker.subscribe(self.spectrum.update)
+            self.worker = worker
+            self.spectrum.reset()
+
+        center = self.main.vb.viewRect().center()
+        self.spectrum.setCrop(int(self.sizeBox.currentText()),
+                              (center.x(), center.y()))
+
+        # Nothing to draw until a new spectrum is averaged
+        version = self.spectrum.version
+        if version == self.shownVersion:
+            return
+        self.shownVersion = version
+        power = self.spectrum.spectrum()
+        if power is None:
+            return
+        autoLevels = version == 1 or self.f is None
+        self.f = np.log10(power + 1)
+        self.showFFT(autoLevels)
 
     def closeEvent(self, *args, **kwargs):
+        self.stopStream()
         super().closeEvent(*args, **kwargs)
 
     def changePos(self):
-        # Move vertical lines
-        pos = float(1 / float(self.linePos.text()))
-        self.rvline.setValue((0.5+pos)*self.imgWidth)
-        self.lvline.setValue((0.5-pos)*self.imgWidth)
-        self.dhline.setAngle(0)
-        self.dhline.setValue((0.5-pos)*self.imgHeight)
-        self.uhline.setAngle(0)
-        self.uhline.setValue((0.5+pos)*self.imgHeight)
+        self.setLines()
 
         if self.init == False:
             self.vline.show()
@@ -928,3 +1070,23 @@ class FFTWidget(QtGui.QFrame):
             self.dhline.show()
             self.init = True
 
+    def setLines(self):
+        # Move the lines to the frequency of the period, by default F = 0.25,
+        # period of T = 4 pixels
+        if self.imgWidth is None:
+            return
+        # The last valid period is kept if the text is not one
+        try:
+            period = float(self.linePos.text())
+        except ValueError:
+            period = 0
+        if period != 0 and np.isfinite(period):
+            self.period = period
+        pos = 1 / self.period
+        self.rvline.setValue((0.5+pos)*self.imgWidth)
+        self.lvline.setValue((0.5-pos)*self.imgWidth)
+        self.dhline.setAngle(0)
+        self.dhline.setValue((0.5-pos)*self.imgHeight)
+        self.uhline.setAngle(0)
+        self.uhline.setValue((0.5+pos)*self.imgHeight)
+
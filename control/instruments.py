@@ -195,7 +195,12 @@ class Cameras(object):
     called alot or environments that are used alot."""
 
 
-    def __new__(cls, *args, **kwargs):
+    def __new__(cls, *args, replay=None, speed=1, **kwargs):
+        # Stream a recording instead of using the cameras
+        if replay is not None:
+            print('Initializing Replay Hamamatsu with', replay)
+            return [mockers.ReplayHamamatsu(replay, speed)]
+
         cameras = []
         try:     
             import lantz.drivers.hamamatsu.hamamatsu_camera as hm
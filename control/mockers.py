@@ -7,7 +7,11 @@ Created on Tue Aug 12 20:02:08 2014
 
 import ctypes
 import ctypes.util
+import os
 import numpy as np
+import time
+import h5py as hdf
+import tifffile as tiff
 
 import logging
 
@@ -19,6 +23,12 @@ from lantz import Action, Feat
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s',
                     datefmt='%Y-%d-%m %H:%M:%S')
 
+# Same per-frame metadata record as the real camera driver
+FRAME_METADATA_DTYPE = np.dtype([('frame_number', np.int64),
+                                 ('buffer_index', np.int32),
+                                 ('timestamp', np.float64),
+                                 ('backlog', np.int32)])
+
 
 class constants:
 
@@ -115,9 +125,14 @@ class HMockCamData():
     # Create a data object of the appropriate size.
     #
     # @param size The size of the data object in bytes.
-    #
-    def __init__(self, size):
-        self.np_array = np.random.randint(1, 65536, int(size))
+    # @param np_array (Optional) Existing uint16 memory to use, for instance
+    #    a buffer of the MockHamamatsu ring, instead of allocating.
+    #
+    def __init__(self, size, np_array=None):
+        if np_array is None:
+            np_array = np.random.randint(1, 65536, int(size / 2),
+                                         dtype=np.uint16)
+        self.np_array = np_array
         self.size = size
 
     # __getitem__
@@ -152,10 +167,86 @@ class HMockCamData():
         return self.np_array.ctypes.data
 
 
+class HMockFrame():
+    ''' Read-only frame view with the same interface as the HCamFrame of the
+    real camera driver.'''
+
+    def __init__(self, camera, metadata):
+        self.camera = camera
+        self.metadata = metadata
+        self.index = int(metadata['buffer_index'])
+        self.number = int(metadata['frame_number'])
+        self.frame_x = camera.frame_x
+        self.frame_y = camera.frame_y
+        self.np_array = camera.hcam_data[self.index].view()
+        self.np_array.flags.writeable = False
+
+    def getData(self):
+        return self.np_array
+
+    def getImage(self):
+        return np.reshape(self.np_array, (self.frame_x, self.frame_y), 'F')
+
+    def isValid(self):
+        return self.camera.isFrameValid(self.number)
+
+
+class HMockRun():
+    ''' Read-only run of consecutive frames with the same interface as the
+    HCamRun of the real camera driver.'''
+
+    def __init__(self, camera, start, stop, metadata):
+        self.camera = camera
+        self.start = start
+        self.stop = stop
+        self.metadata = metadata
+        self.numbers = metadata['frame_number']
+        self.number = int(self.numbers[0])
+        self.frame_x = camera.frame_x
+        self.frame_y = camera.frame_y
+        self.np_array = camera.hcam_data[start:stop].view()
+        self.np_array.flags.writeable = False
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def getData(self):
+        return self.np_array
+
+    def getImage(self, i=-1):
+        return np.reshape(self.np_array[i], (self.frame_x, self.frame_y), 'F')
+
+    def getImages(self):
+        images = self.np_array.reshape(len(self), self.frame_y, self.frame_x)
+        return images.transpose(0, 2, 1)
+
+    def countInvalid(self):
+        return int(np.count_nonzero(~self.camera.isFrameValid(self.numbers)))
+
+    def isValid(self):
+        return self.camera.isFrameValid(self.number)
+
+
 class MockHamamatsu(Driver):
+    ''' Synthetic camera with the interface of HamamatsuCameraMR.
 
-    def __init__(self):
+    Frames are "exposed" in real time at the camera frame rate into a
+    preallocated uint16 ring of buffers, with the same newFrames semantics
+    as the real camera: frame counters, backlog and overruns when the ring
+    is not read fast enough. Their content is a fixed-pattern offset plus
+    Poisson noise over a background and blinking PSFs, taken from a bank of
+    frames computed when the ROI changes, so producing a frame costs a single
+    copy.
+
+    @param frameRate Fixed frame rate in Hz, by default it follows the
+        exposure time and the readout time of the ROI.
+    @param bufferBudget Bytes of memory for the ring of buffers.
+    @param bankBudget Bytes of memory for the bank of precomputed frames.'''
 
+    def __init__(self, frameRate=None, bufferBudget=256*1024**2,
+                 bankBudget=128*1024**2):
+
+        self.acquiring = False
         self.buffer_index = 0
         self.camera_id = 9999
         self.camera_model = b'Mock Hamamatsu camera'
@@ -163,11 +254,21 @@ class MockHamamatsu(Driver):
         self.frame_x = 500
         self.frame_y = 500
         self.frame_bytes = self.frame_x * self.frame_y * 2
+        self.frame_metadata = np.zeros(0, dtype=FRAME_METADATA_DTYPE)
         self.last_frame_number = 0
         self.properties = {}
         self.max_backlog = 0
+        self.overruns = 0
         self.number_image_buffers = 0
-        self.hcam_data = []
+        self.hcam_data = np.zeros((0, 0), dtype=np.uint16)
+
+        self.frameRate = frameRate
+        self.bufferBudget = bufferBudget
+        self.bankBudget = bankBudget
+        self.arena = None
+        self.bank = None
+        self.bankShape = None
+        self.startTime = 0
 
         self.s = Q_(1, 's')
 
@@ -179,17 +280,20 @@ class MockHamamatsu(Driver):
 #                         "dcam_open")
         # Get camera properties.
         self.properties = {'Name': 'MOCK Hamamatsu',
-                           'exposure_time': 9999,  # * self.s,
+                           'exposure_time': 0.01,  # * self.s,
                            'accumulation_time': 99999,  # * self.s,
+                           'binning': 1,
                            'image_width': 2048,
                            'image_height': 2048,
-                           'image_framebytes': 8,
+                           'image_framebytes': 2048 * 2048 * 2,
+                           'subarray_hpos': 0,
+                           'subarray_vpos': 0,
                            'subarray_hsize': 2048,
                            'subarray_vsize': 2048,
                            'subarray_mode': 'OFF',
-                           'timing_readout_time': 9999,
-                           'internal_frame_rate': 9999,
-                           'internal_frame_interval': 9999}
+                           'timing_readout_time': 0.01,
+                           'internal_frame_rate': 100,
+                           'internal_frame_interval': 0.01}
 
         # Get camera max width, height.
         self.max_width = self.getPropertyValue("image_width")[0]
@@ -216,22 +320,107 @@ class MockHamamatsu(Driver):
         @return The return value of the function.'''
         pass
 
-    def getFrames(self):
+    def makeBank(self):
+        ''' Precomputes the frames the camera cycles through for the current
+        ROI. Emitters are spread over the field of view and each one is on in
+        a random subset of the frames.'''
+        shape = (self.frame_y, self.frame_x)
+        nFrames = int(max(4, min(64, self.bankBudget // self.frame_bytes)))
+        offset = 100 + np.random.normal(0, 3, shape)
+        background = 50 + 20 * np.random.random_sample(shape)
+
+        # Gaussian PSF patches of 2*r+1 pixels
+        r = 4
+        nEmitters = max(1, self.frame_x * self.frame_y // 4000)
+        yc = np.random.random_sample(nEmitters) * (self.frame_y - 1)
+        xc = np.random.random_sample(nEmitters) * (self.frame_x - 1)
+        on = np.random.random_sample((nFrames, nEmitters)) < 0.2
+        amplitude = 500
+        sigma = 1.3
+
+        self.bank = np.empty((nFrames, self.frame_x * self.frame_y),
+                             dtype=np.uint16)
+        for i in range(nFrames):
+            photons = background.copy()
+            for y, x in zip(yc[on[i]], xc[on[i]]):
+                y0, x0 = max(0, int(y) - r), max(0, int(x) - r)
+                y1 = min(self.frame_y, int(y) + r + 1)
+                x1 = min(self.frame_x, int(x) + r + 1)
+                yy, xx = np.mgrid[y0:y1, x0:x1]
+                photons[y0:y1, x0:x1] += amplitude * np.exp(
+                    -((yy - y)**2 + (xx - x)**2) / (2 * sigma**2))
+            frame = np.random.poisson(photons) + offset
+            self.bank[i] = np.clip(frame, 0, 65535).ravel()
+
+        self.bankShape = (self.frame_x, self.frame_y)
+
+    def fillBuffers(self, start, stop, numbers):
+        ''' Writes the frames with the given numbers to the buffers in
+        [start, stop).'''
+        np.take(self.bank, numbers % len(self.bank), axis=0,
+                out=self.hcam_data[start:stop])
+
+    def framesDue(self, elapsed):
+        ''' Number of frames read out after elapsed seconds of acquisition.'''
+        return int(elapsed / self.getFrameInterval())
+
+    def readoutTime(self, number):
+        ''' Seconds after the start of the acquisition at which the frame
+        number (counting from 0) is read out.'''
+        return (number + 1) * self.getFrameInterval()
+
+    def getFrameInterval(self):
+        ''' Seconds between frames, limited by the exposure time and by the
+        readout time of the ROI (rolling shutter, about 10 us per pair of
+        lines).'''
+        if self.frameRate is not None:
+            interval = 1 / self.frameRate
+        else:
+            readout = 9.74e-6 * self.frame_y / 2
+            interval = max(self.properties['exposure_time'], readout)
+            self.properties['timing_readout_time'] = readout
+        self.properties['internal_frame_interval'] = interval
+        self.properties['internal_frame_rate'] = 1 / interval
+        return interval
+
+    def getFrames(self, timeout=None):
         ''' Gets all of the available frames.
 
         This will block waiting for new frames even if there new frames
         available when it is called.
 
-        @return [frames, [frame x size, frame y size]]'''
-        frames = []
+        @param timeout Maximum time to wait in milliseconds.
 
-        for i in range(2):
-            # Create storage
-            hc_data = HMockCamData(self.frame_x * self.frame_y)
-            frames.append(hc_data)
+        @return [frames, [frame x size, frame y size]]'''
+        frames = [HMockCamData(self.frame_bytes, self.hcam_data[n])
+                  for n in self.newFrames(timeout)]
 
         return [frames, [self.frame_x, self.frame_y]]
 
+    def getFrameViews(self, timeout=None):
+        ''' Gets all of the available frames as read-only views.
+
+        @param timeout Maximum time to wait in milliseconds.
+
+        @return [HMockFrame, .., HMockFrame]'''
+        self.newFrameRuns(timeout)
+        return [HMockFrame(self, md) for md in self.frame_metadata]
+
+    def getFrameRuns(self, timeout=None):
+        ''' Gets all of the available frames as at most two read-only runs of
+        consecutive buffers.
+
+        @param timeout Maximum time to wait in milliseconds.
+
+        @return [HMockRun, ..]'''
+        runs = []
+        first = 0
+        for start, stop in self.newFrameRuns(timeout):
+            metadata = self.frame_metadata[first:first + stop - start]
+            runs.append(HMockRun(self, start, stop, metadata))
+            first += stop - start
+        return runs
+
     def getModelInfo(self):
         ''' Returns the model of the camera
 
@@ -299,6 +488,9 @@ class MockHamamatsu(Driver):
     #
     def getPropertyValue(self, property_name):
 
+        if property_name in ['internal_frame_rate', 'internal_frame_interval',
+                             'timing_readout_time']:
+            self.getFrameInterval()
         prop_value = self.properties[property_name]
         prop_type = property_name
 
@@ -318,6 +510,79 @@ class MockHamamatsu(Driver):
         else:
             return False
 
+    def isFrameValid(self, number):
+        ''' A frame is valid as long as the camera has not written a full ring
+        of buffers after it.'''
+        return (self.last_frame_number - number) <= self.number_image_buffers
+
+    # newFrameRuns
+    #
+    # Return the buffer index ranges of all the new frames since the last
+    # check, at most two as the ring of buffers wraps at most once. The
+    # metadata of the new frames is left in self.frame_metadata.
+    #
+    # This will block waiting for at least one new frame, or until the
+    # timeout expires or the acquisition is stopped.
+    #
+    # @param timeout Maximum time to wait in milliseconds.
+    #
+    # @return [(start, stop), ..] with stop excluded.
+    #
+    def newFrameRuns(self, timeout=None):
+
+        # Wait for the next frame to be exposed.
+        now = time.perf_counter()
+        cur_frame_number = self.framesDue(now - self.startTime)
+        if cur_frame_number == self.last_frame_number:
+            wait = self.readoutTime(self.last_frame_number) - (
+                now - self.startTime)
+            # Without timeout, wait at most a second at a time
+            if timeout is None:
+                timeout = 1000
+            time.sleep(max(min(wait, timeout / 1000), 0))
+            now = time.perf_counter()
+            cur_frame_number = self.framesDue(now - self.startTime)
+
+        if not self.acquiring or cur_frame_number == self.last_frame_number:
+            self.frame_metadata = self.frame_metadata[:0]
+            return []
+
+        # Frames that were written over before this check are lost.
+        backlog = cur_frame_number - self.last_frame_number
+        if backlog > self.number_image_buffers:
+            print("warning: mock camera frame buffer overrun detected!")
+            self.overruns += backlog - self.number_image_buffers
+        if backlog > self.max_backlog:
+            self.max_backlog = backlog
+        first = max(self.last_frame_number,
+                    cur_frame_number - self.number_image_buffers)
+        self.last_frame_number = cur_frame_number
+
+        # Fill the buffers of the new frames from the bank and get the runs.
+        numbers = np.arange(first, cur_frame_number)
+        indices = numbers % self.number_image_buffers
+        start = int(indices[0])
+        stop = start + len(indices)
+        if stop > self.number_image_buffers:
+            runs = [(start, self.number_image_buffers),
+                    (0, stop - self.number_image_buffers)]
+        else:
+            runs = [(start, stop)]
+        done = 0
+        for start, stop in runs:
+            self.fillBuffers(start, stop, numbers[done:done + stop - start])
+            done += stop - start
+        self.buffer_index = int(indices[-1])
+
+        metadata = np.empty(len(numbers), dtype=FRAME_METADATA_DTYPE)
+        metadata['frame_number'] = numbers
+        metadata['buffer_index'] = indices
+        metadata['timestamp'] = now
+        metadata['backlog'] = backlog
+        self.frame_metadata = metadata
+
+        return runs
+
     # newFrames
     #
     # Return a list of the ids of all the new frames since the last check.
@@ -326,12 +591,9 @@ class MockHamamatsu(Driver):
     #
     # @return [id of the first frame, .. , id of the last frame]
     #
-    def newFrames(self):
-
-        # Create a list of the new frames.
-        new_frames = [0]
-
-        return new_frames
+    def newFrames(self, timeout=None):
+        self.newFrameRuns(timeout)
+        return self.frame_metadata['buffer_index'].tolist()
 
     # setPropertyValue
     #
@@ -359,6 +621,15 @@ class MockHamamatsu(Driver):
 #                return False
         return property_value
 
+    def setPropertyValues(self, property_values):
+        ''' Sets several properties at once.
+
+        @param property_values A dictionary or a list of (name, value) pairs.
+
+        @return A dictionary with the values the properties were set to.'''
+        return {name: self.setPropertyValue(name, value)
+                for name, value in dict(property_values).items()}
+
     # setSubArrayMode
     #
     # This sets the sub-array mode as appropriate based on the current ROI.
@@ -370,6 +641,7 @@ class MockHamamatsu(Driver):
         roi_h = self.getPropertyValue("subarray_vsize")[0]
         self.properties['image_height'] = roi_h
         self.properties['image_width'] = roi_w
+        self.properties['image_framebytes'] = 2 * roi_w * roi_h
 
         # If the ROI is smaller than the entire frame turn on subarray mode
         if ((roi_w == self.max_width) and (roi_h == self.max_height)):
@@ -383,18 +655,36 @@ class MockHamamatsu(Driver):
     #
     def startAcquisition(self):
         self.captureSetup()
-        n_buffers = int((2.0 * 1024 * 1024 * 1024) / self.frame_bytes)
-        self.number_image_buffers = n_buffers
 
-        self.hcam_data = [HMockCamData(self.frame_x * self.frame_y)
-                          for i in range(1, 2)]
+        # The ring of buffers is carved out of memory allocated once.
+        if self.arena is None:
+            self.arena = np.empty(int(self.bufferBudget // 2),
+                                  dtype=np.uint16)
+        frame_words = int(self.frame_bytes // 2)
+        self.number_image_buffers = len(self.arena) // frame_words
+        self.hcam_data = self.arena[
+            :self.number_image_buffers * frame_words].reshape(
+                self.number_image_buffers, frame_words)
+
+        if self.bankShape != (self.frame_x, self.frame_y):
+            self.makeBank()
+
+        self.startTime = time.perf_counter()
+        self.acquiring = True
 
     # stopAcquisition
     #
     # Stop data acquisition.
     #
     def stopAcquisition(self):
-        pass
+        self.acquiring = False
+
+        print("max camera backlog was", self.max_backlog, "of",
+              self.number_image_buffers)
+        self.max_backlog = 0
+        if self.overruns > 0:
+            print("frames lost to buffer overruns:", self.overruns)
+            self.overruns = 0
 
     # shutdown
     #
@@ -404,6 +694,172 @@ class MockHamamatsu(Driver):
         pass
 
 
+class PlaneFrames():
+    ''' Frames of a (t, z, frame, x, y) scan dataset as an (n, x, y) stack,
+    read from the file when sliced, one (t, z) plane at a time.'''
+
+    def __init__(self, images):
+        self.images = images
+        self.framesPerPlane = images.shape[2]
+        self.shape = (int(np.prod(images.shape[:3])),) + images.shape[3:]
+        self.dtype = images.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        start, stop, step = index.indices(len(self))
+        frames = np.empty((max(0, stop - start),) + self.shape[1:],
+                          dtype=self.dtype)
+        done = 0
+        while start + done < stop:
+            plane, first = divmod(start + done, self.framesPerPlane)
+            t, z = divmod(plane, self.images.shape[1])
+            k = min(stop - start - done, self.framesPerPlane - first)
+            frames[done:done + k] = self.images[t, z, first:first + k]
+            done += k
+        return frames[::step]
+
+
+class ReplayHamamatsu(MockHamamatsu):
+    ''' Camera that streams the frames of an existing recording, a .hdf5
+    file written by RecWorker (dataset 'Images', all the frames of scans
+    one after the other) or a .tiff, with the interface of
+    HamamatsuCameraMR.
+
+    The file is memory-mapped when its layout allows it, otherwise frames are
+    read as needed. Frames are delivered at the pace of the recorded frame
+    timestamps (the FrameMetadata of the recording) or at frameRate if given,
+    both accelerated by speed. With loop the recording starts over when it
+    ends, otherwise the camera stops delivering frames.
+
+    @param filename The recording to replay.
+    @param speed Replay speed relative to the original rate.
+    @param frameRate Frame rate in Hz to use instead of the recorded one.
+    @param loop Whether to replay the recording over and over.
+    @param dataset Dataset with the frames in .hdf5 files.'''
+
+    def __init__(self, filename, speed=1, frameRate=None, loop=True,
+                 dataset='Images', *args, **kwargs):
+        super().__init__(frameRate, *args, **kwargs)
+        self.filename = filename
+        self.speed = speed
+        self.loop = loop
+        self.camera_model = b'Replay Hamamatsu camera'
+
+        self.storeFile = None
+        root, ext = os.path.splitext(filename)
+        if ext in ['.hdf5', '.h5']:
+            self.storeFile = hdf.File(filename, 'r')
+            images = self.storeFile[dataset]
+            self.bank = self.mapDataset(images)
+            if 'FrameMetadata' in self.storeFile:
+                metadata = self.storeFile['FrameMetadata'][:]
+            else:
+                metadata = None
+        else:
+            try:
+                self.bank = tiff.memmap(filename)
+            except ValueError:
+                self.bank = tiff.imread(filename)
+            if self.bank.ndim == 2:
+                self.bank = self.bank[np.newaxis]
+            try:
+                metadata = np.load(root + '_metadata.npy')
+            except IOError:
+                metadata = None
+
+        # Recordings store frames as (n, x, y)
+        self.nFrames, width, height = self.bank.shape
+        self.bankShape = (width, height)
+        self.frame_x, self.frame_y = width, height
+        self.max_width, self.max_height = width, height
+        self.properties.update({'image_width': width,
+                                'image_height': height,
+                                'image_framebytes': 2 * width * height,
+                                'subarray_hsize': width,
+                                'subarray_vsize': height})
+
+        # Readout time of each frame of the recording, relative to the first
+        if self.frameRate is None and metadata is not None \
+                and len(metadata) == self.nFrames and self.nFrames > 1:
+            timestamps = metadata['timestamp'] - metadata['timestamp'][0]
+            interval = timestamps[-1] / (self.nFrames - 1)
+        else:
+            if self.frameRate is None:
+                print('No frame timestamps in', filename, 'replaying at the '
+                      'exposure time rate')
+            interval = super().getFrameInterval()
+            timestamps = np.arange(self.nFrames) * interval
+        self.frameTimes = timestamps + interval
+        self.period = self.frameTimes[-1]
+
+    def mapDataset(self, images):
+        ''' Memory-maps a contiguous, uncompressed dataset. Chunked datasets
+        (the ones RecWorker writes) are read through h5py, scans, (t, z,
+        frame, x, y) datasets, plane by plane as a stack of frames.'''
+        if images.ndim == 5:
+            return PlaneFrames(images)
+        if images.chunks is None and images.compression is None:
+            return np.memmap(self.filename, dtype=images.dtype, mode='r',
+                             offset=images.id.get_offset(),
+                             shape=images.shape)
+        return images
+
+    def captureSetup(self):
+        ''' The frame size is the one of the recording, whatever the ROI.'''
+        self.buffer_index = -1
+        self.last_frame_number = 0
+        self.frame_x, self.frame_y = self.bankShape
+        self.frame_bytes = 2 * self.frame_x * self.frame_y
+
+    def makeBank(self):
+        pass
+
+    def fillBuffers(self, start, stop, numbers):
+        ''' Copies the recorded frames into the buffers, transposing them
+        from the (n, x, y) order of the file to the camera's.'''
+        images = self.hcam_data[start:stop].reshape(
+            stop - start, self.frame_y, self.frame_x)
+        sources = numbers % self.nFrames
+        # The numbers are consecutive, so they wrap around the recording
+        # (any number of times) in contiguous chunks of the bank
+        done = 0
+        while done < len(sources):
+            first = int(sources[done])
+            k = min(len(sources) - done, self.nFrames - first)
+            images[done:done + k] = np.asarray(
+                self.bank[first:first + k]).transpose(0, 2, 1)
+            done += k
+
+    def framesDue(self, elapsed):
+        t = elapsed * self.speed
+        cycles = int(t // self.period)
+        if not self.loop and cycles > 0:
+            return self.nFrames
+        return (cycles * self.nFrames +
+                int(np.searchsorted(self.frameTimes, t - cycles * self.period,
+                                    side='right')))
+
+    def readoutTime(self, number):
+        cycles, i = divmod(number, self.nFrames)
+        if not self.loop and cycles > 0:
+            return float('inf')
+        return (cycles * self.period + self.frameTimes[i]) / self.speed
+
+    def getFrameInterval(self):
+        interval = self.period / self.nFrames / self.speed
+        self.properties['internal_frame_interval'] = interval
+        self.properties['internal_frame_rate'] = 1 / interval
+        return interval
+
+    def shutdown(self):
+        if self.storeFile is not None:
+            self.storeFile.close()
+            self.storeFile = None
+
+
 class MockPZT(Driver):
     """Mock Driver for the nv401.
     """
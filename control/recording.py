@@ -4,10 +4,15 @@ Created on Thu Mar 29 11:27:57 2018
 
 @author: Tempesta_team
 """
+import multiprocessing as mp
 import os
+import queue
+import shutil
 import sys
 import subprocess
+import threading
 import time
+import traceback
 import numpy as np
 import re
 
@@ -19,6 +24,8 @@ import pyqtgraph.ptime as ptime
 from tkinter import Tk, filedialog, messagebox
 
 import control.guitools as guitools
+import control.buffers as buffers
+import control.writers as writers
 
 
 # Widget to control image or sequence recording. Recording only possible when
@@ -40,10 +47,25 @@ class RecordingWidget(QtGui.QFrame):
         self.recWorkers = [None] * len(self.main.cameras)
         self.recThreads = [None] * len(self.main.cameras)
         self.savenames = [None] * len(self.main.cameras)
+        # Writers kept open across the scans of a time-lapse
+        self.stackWriters = [None] * len(self.main.cameras)
 
         self.z_stack = []
         self.recMode = 1
 
+        # Bytes of memory for the queue of frames waiting to be written
+        self.queueMemory = 1024**3
+
+        # Write bandwidth in bytes/s measured for each (folder, format) of
+        # the session, in a background thread when either of them changes
+        self.bandwidths = {}
+        self.benchmarkThread = None
+
+        # Raw recordings of the current session, converted to HDF5 in the
+        # background once it ends.
+        self.rawFiles = []
+        self.rawConverterThreads = []
+
         self.dataDir = r"D:\Data"
         self.initialDir = os.path.join(self.dataDir, time.strftime('%Y-%m-%d'))
 
@@ -68,7 +90,13 @@ class RecordingWidget(QtGui.QFrame):
         self.filenameEdit = QtGui.QLineEdit('Current_time')
         self.formatBox = QtGui.QComboBox()
         self.formatBox.addItem('tiff')
+        self.formatBox.addItem('bigtiff')
         self.formatBox.addItem('hdf5')
+        self.formatBox.addItem('hdf5 (lzf)')
+        self.formatBox.addItem('hdf5 (gzip)')
+        self.formatBox.addItem('raw')
+        self.folderEdit.editingFinished.connect(self.measureBandwidth)
+        self.formatBox.currentIndexChanged.connect(self.measureBandwidth)
 
         # Snap and recording buttons
         self.snapTIFFButton = QtGui.QPushButton('Snap')
@@ -110,9 +138,25 @@ class RecordingWidget(QtGui.QFrame):
         self.currentFrame.setAlignment((QtCore.Qt.AlignRight |
                                         QtCore.Qt.AlignVCenter))
         self.numExpositionsEdit = QtGui.QLineEdit('100')
+        self.splitCheck = QtGui.QCheckBox('Split every [GB]')
+        self.splitEdit = QtGui.QLineEdit('4')
+        splitValidator = QtGui.QDoubleValidator(0.001, 1e6, 3)
+        splitValidator.setNotation(QtGui.QDoubleValidator.StandardNotation)
+        # Same decimal point as float()
+        splitValidator.setLocale(QtCore.QLocale.c())
+        self.splitEdit.setValidator(splitValidator)
+        self.partBytes = None
+        self.processCheck = QtGui.QCheckBox('Writer processes')
+        self.processCheck.setToolTip('Write each camera from its own process')
         self.tRemaining = QtGui.QLabel()
         self.tRemaining.setAlignment((QtCore.Qt.AlignCenter |
                                       QtCore.Qt.AlignVCenter))
+        self.writeSpeed = QtGui.QLabel()
+        self.writeSpeed.setAlignment((QtCore.Qt.AlignCenter |
+                                      QtCore.Qt.AlignVCenter))
+        self.healthLabel = QtGui.QLabel()
+        self.healthLabel.setAlignment((QtCore.Qt.AlignLeft |
+                                       QtCore.Qt.AlignVCenter))
         self.numExpositionsEdit.textChanged.connect(self.filesizeupdate)
 
         self.progressBar = QtGui.QProgressBar()
@@ -156,6 +200,7 @@ class RecordingWidget(QtGui.QFrame):
         recGrid.addWidget(self.specifyFrames, 5, 0, 1, 5)
         recGrid.addWidget(self.currentFrame, 5, 1)
         recGrid.addWidget(self.numExpositionsEdit, 5, 2)
+        recGrid.addWidget(self.writeSpeed, 5, 3, 1, 2)
         recGrid.addWidget(self.specifyTime, 6, 0, 1, 5)
         recGrid.addWidget(self.currentTime, 6, 1)
         recGrid.addWidget(self.timeToRec, 6, 2)
@@ -167,7 +212,11 @@ class RecordingWidget(QtGui.QFrame):
         recGrid.addWidget(self.timeLapseEdit, 8, 2)
         recGrid.addWidget(self.timeLapseTotalEdit, 8, 3)
         recGrid.addWidget(self.untilSTOPbtn, 9, 0, 1, 5)
-        recGrid.addWidget(buttonWidget, 10, 0, 1, 0)
+        recGrid.addWidget(self.splitCheck, 10, 0, 1, 2)
+        recGrid.addWidget(self.splitEdit, 10, 2)
+        recGrid.addWidget(self.processCheck, 10, 3, 1, 2)
+        recGrid.addWidget(self.healthLabel, 11, 0, 1, 5)
+        recGrid.addWidget(buttonWidget, 12, 0, 1, 0)
 
         recGrid.setColumnMinimumWidth(0, 70)
 
@@ -213,6 +262,9 @@ class RecordingWidget(QtGui.QFrame):
             self.timeToRec.setEnabled(False)
 #        self.folderEdit.setEnabled(value)
 #        self.filenameEdit.setEnabled(value)
+        self.splitCheck.setEnabled(value)
+        self.splitEdit.setEnabled(value)
+        self.processCheck.setEnabled(value)
         self._writable = value
 
     def specFile(self):
@@ -327,9 +379,31 @@ class RecordingWidget(QtGui.QFrame):
             root.destroy()
             if folder != '':
                 self.folderEdit.setText(folder)
+                self.measureBandwidth()
         except OSError:
             pass
 
+    def measureBandwidth(self):
+        ''' Starts measuring in the background how fast the selected format
+        is written to the selected folder, unless it is already known.'''
+        key = (self.folderEdit.text(), self.formatBox.currentText())
+        if (key in self.bandwidths or not os.path.isdir(key[0]) or
+                (self.benchmarkThread is not None and
+                 self.benchmarkThread.is_alive())):
+            return
+        shape = max(self.main.shapes, key=np.prod)
+        self.benchmarkThread = threading.Thread(
+            target=self.benchmark, args=(key, shape), daemon=True)
+        self.benchmarkThread.start()
+
+    def benchmark(self, key, shape):
+        folder, saveMode = key
+        try:
+            self.bandwidths[key] = writers.benchmark(saveMode, folder, shape)
+        except OSError:
+            print('Could not measure the bandwidth of', folder)
+            traceback.print_exc()
+
     # Attributes saving
     def getAttrs(self):
         self.main.AbortROI()
@@ -409,6 +483,9 @@ class RecordingWidget(QtGui.QFrame):
 
         eSecs = self.recWorkers[self.main.currCamIdx].tRecorded
         nframe = self.recWorkers[self.main.currCamIdx].nStored
+        stats = self.recWorkers[self.main.currCamIdx].stats
+        self.writeSpeed.setText('{:.0f} MB/s'.format(stats.mbPerSecond()))
+        self.updateHealth(stats)
 #        rSecs = self.getTimeOrFrames() - eSecs
 #        rText = '{}'.format(datetime.timedelta(seconds=max(0, rSecs)))
 #        self.tRemaining.setText(rText)
@@ -416,12 +493,141 @@ class RecordingWidget(QtGui.QFrame):
         self.currentTime.setText(str(int(eSecs)) + ' /')
 #        self.progressBar.setValue(100*(1 - rSecs / (eSecs + rSecs)))
 
+    def updateHealth(self, stats):
+        ''' Shows the recording metrics, in red once frames are being lost
+        or the queue is filling up.'''
+        text = ('Acquired {} | written {} | queue {}/{} (peak {})\n'
+                'Worst write {:.0f} ms | camera backlog {} (max {})\n'
+                'Missing {} | dropped {} | overwritten {}').format(
+            stats.acquired, stats.written, len(stats.queue),
+            stats.queue.capacity, stats.queue.highWater,
+            1000 * stats.worstLatency, stats.backlog, stats.maxBacklog,
+            stats.missing, stats.queue.dropped, stats.overwritten)
+        self.healthLabel.setText(text)
+        if stats.healthy():
+            self.healthLabel.setStyleSheet('')
+        else:
+            self.healthLabel.setStyleSheet('color: red')
+
+    def preflight(self):
+        ''' Checks before recording that the disk can take it: the sustained
+        bandwidth the cameras need against a short write benchmark of the
+        selected format in the target folder, run once per session, and the expected size against
+        the free space. Returns whether to go on with the recording.'''
+        folder = self.folderEdit.text()
+        try:
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+        except OSError:
+            self.folderWarning()
+            return False
+        saveMode = self.formatBox.currentText()
+
+        # Bytes/s of all the recording cameras, and duration of the longest
+        # uninterrupted stretch of frames and total size, if they are known
+        required = 0
+        intervals = []
+        frameBytes = 0
+        for i in range(0, self.nCameras):
+            ind = np.mod(self.main.currCamIdx + i, 2)
+            interval = self.main.cameras[ind].getPropertyValue(
+                'internal_frame_interval')[0]
+            intervals.append(interval)
+            frameBytes += 2 * np.prod(self.main.shapes[ind])
+            required += 2 * np.prod(self.main.shapes[ind]) / interval
+        if self.recMode == 1:
+            duration = self.n() * max(intervals)
+            size = required * duration
+        elif self.recMode == 2:
+            duration = float(self.timeToRec.text())
+            size = required * duration
+        elif self.recMode in [3, 4]:
+            # Frames of each scan come at the pace of the scan
+            scanWidget = self.main.scanWidget
+            frames = scanWidget.stageScan.frames
+            duration = scanWidget.scanDuration
+            if duration > 0:
+                required = frames * frameBytes / duration
+            scans = 1
+            if self.recMode == 4:
+                scans = int(np.ceil(float(self.timeLapseTotalEdit.text()) /
+                                    float(self.timeLapseEdit.text())))
+            size = scans * frames * frameBytes
+        else:
+            duration = None
+            size = None
+
+        # Measured once per folder and format, waiting for a measurement
+        # that is already running
+        key = (folder, saveMode)
+        if self.benchmarkThread is not None:
+            self.benchmarkThread.join()
+        if key not in self.bandwidths:
+            shape = max(self.main.shapes, key=np.prod)
+            self.bandwidths[key] = writers.benchmark(saveMode, folder, shape)
+        measured = self.bandwidths[key]
+        free = shutil.disk_usage(folder).free
+
+        MB = 1024**2
+        GB = 1024**3
+        numbers = ('Needed: {:.0f} MB/s ({} camera(s))\n'
+                   'Measured {} writing: {:.0f} MB/s\n'
+                   'Free space: {:.1f} GB').format(
+            required / MB, self.nCameras, saveMode, measured / MB, free / GB)
+        print(numbers.replace('\n', ', '))
+
+        if size is not None and size > free:
+            QtGui.QMessageBox.critical(
+                self, 'Not enough disk space',
+                'The recording needs {:.1f} GB.\n\n{}'.format(
+                    size / GB, numbers))
+            return False
+
+        problems = []
+        if required > measured:
+            # The queues take the excess until they are full
+            fill = self.nCameras * self.queueMemory / (required - measured)
+            if duration is None or duration > fill:
+                problems.append('The disk can not keep up, frames will be '
+                                'dropped after about {:.0f} s.'.format(fill))
+        if duration is None:
+            full = free / min(required, measured)
+            if full < 600:
+                problems.append('The disk will be full in about '
+                                '{:.0f} s.'.format(full))
+        if len(problems) == 0:
+            return True
+
+        ret = QtGui.QMessageBox.warning(
+            self, 'Recording bandwidth',
+            '{}\n\n{}\n\nRecord anyway?'.format(' '.join(problems),
+                                                 numbers),
+            QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+        return ret == QtGui.QMessageBox.Yes
+
     def startRecording(self):
         ''' Called when "Rec" button is pressed.'''
         if self.recButton.isChecked():
+            # Parsed here, the recording workers can not stop on bad input
+            if self.splitCheck.isChecked():
+                if not self.splitEdit.hasAcceptableInput():
+                    QtGui.QMessageBox.warning(
+                        self, 'Split size',
+                        'The size of the parts must be a number of GB '
+                        'larger than 0.')
+                    self.recButton.setChecked(False)
+                    return
+                self.partBytes = float(self.splitEdit.text()) * 1024**3
+            else:
+                self.partBytes = None
+            if not self.preflight():
+                self.recButton.setChecked(False)
+                return
             ret = QtGui.QMessageBox.Yes
-            # Checks if estimated file size is dangerously large, > 1,5GB-.
-            if self.filesize > 1500000000:
+            # Checks if estimated file size is dangerously large, > 1,5GB-,
+            # for classic TIFF files (limited to 4 GB).
+            if self.filesize > 1500000000 and \
+                    self.formatBox.currentText() == 'tiff':
                 ret = self.filesizewar.exec_()
 
             if ret == QtGui.QMessageBox.Yes:
@@ -465,7 +671,12 @@ class RecordingWidget(QtGui.QFrame):
 
     def doRecording(self):
         if not self.main.scanWidget.scanning:
-            self.makeSavenames()
+            if all(writer is None for writer in self.stackWriters):
+                self.makeSavenames()
+            if self.formatBox.currentText() == 'raw':
+                self.rawFiles.extend(
+                    self.savenames[np.mod(self.main.currCamIdx + i, 2)] +
+                    '.raw' for i in range(self.nCameras))
             for i in range(0, self.nCameras):
                 ind = np.mod(self.main.currCamIdx + i, 2)
 
@@ -475,12 +686,14 @@ class RecordingWidget(QtGui.QFrame):
                     self.getTimeOrFrames(), self.main.shapes[ind],
                     self.main.lvworkers[ind], self.main.RealExpPar,
                     self.savenames[ind], self.dataname, self.getAttrs())
+                self.recWorkers[ind].stackWriter = self.stackWriters[ind]
                 # Connects the updatesignal that is continously emitted
                 # from recworker to updateGUI function.
                 self.recWorkers[ind].updateSignal.connect(self.updateGUI)
                 # Connects the donesignal emitted from recworker to
                 # endrecording function.
                 self.recWorkers[ind].doneSignal.connect(self.endRecording)
+                self.recWorkers[ind].errorSignal.connect(self.recordingError)
                 # Creates a new thread
                 self.recThreads[ind] = QtCore.QThread()
                 # moves the worker object to this thread.
@@ -505,6 +718,7 @@ class RecordingWidget(QtGui.QFrame):
                 ind = np.mod(self.main.currCamIdx + i, 2)
                 self.recThreads[ind].terminate()
                 # Same as done in Liveviewrun()
+                self.stackWriters[ind] = self.recWorkers[ind].stackWriter
 
             if self.recMode != 4:
                 self.writable = True
@@ -516,10 +730,13 @@ class RecordingWidget(QtGui.QFrame):
                 self.progressBar.setValue(0)
                 self.currentTime.setText('0 /')
                 self.currentFrame.setText('0 /')
+                self.writeSpeed.setText('')
+                self.convertRawFiles()
             else:
                 self.timeLapseScan -= 1
                 if self.timeLapseScan <= 0:
                     self.timer.stop()
+                    self.closeStackWriters()
                     self.writable = True
                     self.readyToRecord = True
                     self.recButton.setEnabled(True)
@@ -530,6 +747,44 @@ class RecordingWidget(QtGui.QFrame):
                     self.progressBar.setValue(0)
                     self.currentTime.setText('0 /')
                     self.currentFrame.setText('0 /')
+                    self.writeSpeed.setText('')
+                    self.convertRawFiles()
+
+    def recordingError(self, message):
+        ''' A recording worker could not store its frames. The recording
+        ends, time-lapses included, when the workers are done.'''
+        if self.recMode == 4:
+            self.timeLapseScan = 1
+        QtGui.QMessageBox.critical(
+            self, 'Recording failed',
+            'The frames could not be stored:\n\n{}'.format(message))
+
+    def closeStackWriters(self):
+        ''' Closes the files of a finished time-lapse.'''
+        for i, writer in enumerate(self.stackWriters):
+            if writer is not None:
+                writer.close()
+                self.stackWriters[i] = None
+
+    def convertRawFiles(self):
+        ''' Converts the raw recordings of the session that just ended.'''
+        if len(self.rawFiles) > 0:
+            # Recordings split in parts are converted part by part
+            files = []
+            for name in self.rawFiles:
+                indexName = os.path.splitext(name)[0] + '_index.json'
+                if os.path.exists(indexName):
+                    index = writers.RolloverIndex(indexName)
+                    files.extend(os.path.join(index.folder, part['name']) +
+                                 '.raw' for part in index.parts)
+                else:
+                    files.append(name)
+            self.rawFiles = files
+            self.rawConverterThreads = [
+                t for t in self.rawConverterThreads if t.isRunning()]
+            self.rawConverterThreads.append(
+                guitools.RawConverterThread(self.rawFiles))
+            self.rawFiles = []
 
     def makeSavenames(self):
         folder = self.folderEdit.text()
@@ -553,9 +808,14 @@ class RecordingWidget(QtGui.QFrame):
 
 
 class RecWorker(QtCore.QObject):
+    ''' Stores the frames of one camera during a recording. The acquisition
+    thread puts them in a bounded FrameQueue and this worker, in its own
+    thread, hands them to the writer of the chosen format, so that slow disk
+    writes are absorbed by the queue.'''
 
     updateSignal = QtCore.pyqtSignal()
     doneSignal = QtCore.pyqtSignal()
+    errorSignal = QtCore.pyqtSignal(str)
 
     def __init__(self, main, camera, recMode, timeorframes, shape, lvworker,
                  t_exp, savename, dataname, attrs, *args, **kwargs):
@@ -581,78 +841,56 @@ class RecWorker(QtCore.QObject):
 
         self.nStored = 0  # number of frames stored
         self.tRecorded = 0
+        self.queue = None
+        self.stats = None
+        # Open writer of the previous scans of a time-lapse, if any
+        self.stackWriter = None
+
+    def record(self, runs):
+        ''' Called from the acquisition thread with every list of new runs of
+        frames.'''
+        for run in runs:
+            self.queue.write(run.getImages(), run.metadata)
+            if not run.isValid():
+                self.stats.overwritten += run.countInvalid()
+
+    def recording(self):
+        ''' Whether frames still have to be stored.'''
+        if not self.pressed:
+            return False
+        elif self.recMode == 1:
+            return self.nStored < self.timeorframes
+        elif self.recMode == 2:
+            return self.tRecorded < self.timeorframes
+        elif self.recMode in [3, 4]:
+            return self.nStored < self.nFrames
+        else:
+            return True
 
     def start(self):
-        self.lvworker.startRecording()
-        time.sleep(0.1)
-
-        self.starttime = time.time()
+        ''' Records, leaving the acquisition and the GUI ready for the next
+        recording even if storing the frames fails.'''
+        try:
+            self.run()
+        except Exception as e:
+            traceback.print_exc()
+            self.errorSignal.emit('{}: {}'.format(type(e).__name__, e))
+        finally:
+            if self.queue is not None:
+                self.lvworker.unsubscribe(self.record)
+                self.queue.close()
+            self.done = True
+            self.doneSignal.emit()
+
+    def run(self):
         saveMode = self.main.formatBox.currentText()
+        frameShape = (self.camera.frame_x, self.camera.frame_y)
 
-        # Main loop for waiting until recording is finished and sending update
-        # signal
+        # Frames to expect, if known, and frames of each z plane for scans
+        framesPerPlane = None
         if self.recMode == 1:
-            if saveMode == 'tiff':
-                with tiff.TiffWriter(self.savename + '.tiff',
-                                     software='Tormenta') as storeFile:
-                    while self.nStored < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        self.nStored += len(newFrames)
-                        for frame in newFrames:
-                            storeFile.save(frame)
-                        self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    storeFile.create_dataset(
-                        'Images', (1, self.shape[0], self.shape[1]),
-                        maxshape=(None, self.shape[0], self.shape[1]))
-                    dataset = storeFile['Images']
-                    while self.nStored < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        dataset.resize((self.nStored+len(newFrames)), axis=0)
-                        dataset[self.nStored:] = newFrames
-                        self.nStored += len(newFrames)
-                        self.updateSignal.emit()
-
-        elif self.recMode == 2:
-            if saveMode == 'tiff':
-                with tiff.TiffWriter(self.savename + '.tiff',
-                                     software='Tormenta') as storeFile:
-                    while self.tRecorded < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        self.nStored += len(newFrames)
-                        for frame in newFrames:
-                            storeFile.save(frame)
-                        self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    storeFile.create_dataset(
-                        'Images', (1, self.shape[0], self.shape[1]),
-                        maxshape=(None, self.shape[0], self.shape[1]))
-                    dataset = storeFile['Images']
-                    while self.tRecorded < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        dataset.resize((self.nStored + len(newFrames)), axis=0)
-                        dataset[self.nStored:] = newFrames
-                        self.nStored += len(newFrames)
-                        self.updateSignal.emit()
-
+            self.nFrames = self.timeorframes
         elif self.recMode in [3, 4]:
-            # Change setting for scanning
-            self.main.main.trigsourceparam.setValue('External "frame-trigger"')
-            laserWidget = self.main.main.laserWidgets
-            laserWidget.DigCtrl.DigitalControlButton.setChecked(True)
-
             # Getting Z steps
             if self.scanWidget.scanMode.currentText() == 'VOL scan':
                 sizeZ = self.scanWidget.scanParValues['sizeZ']
@@ -660,76 +898,143 @@ class RecWorker(QtCore.QObject):
                 stepsZ = int(np.ceil(sizeZ / stepSizeZ))
             else:
                 stepsZ = 1
-            framesExpected = int(self.scanWidget.stageScan.frames / stepsZ)
+            self.nFrames = self.scanWidget.stageScan.frames
+            framesPerPlane = int(self.nFrames / stepsZ)
+            self.nFrames = framesPerPlane * stepsZ
+        else:
+            self.nFrames = None
+
+        frameBytes = 2 * frameShape[0] * frameShape[1]
+        capacity = max(1, self.main.queueMemory // frameBytes)
+        if self.nFrames is not None:
+            capacity = min(capacity, self.nFrames)
+        # Time-lapse scans go to a single HDF5 file, open across the scans
+        container = (self.recMode == 4 and saveMode.startswith('hdf5') and
+                     self.main.partBytes is None)
+        inProcess = self.main.processCheck.isChecked() and not container
+        if inProcess:
+            self.queue = buffers.SharedFrameQueue(frameShape, capacity)
+        else:
+            self.queue = buffers.FrameQueue(frameShape, capacity)
+        self.stats = buffers.RecordingStats(self.queue)
+        self.lvworker.subscribe(self.record)
+
+        self.starttime = time.time()
+        args = (saveMode, self.savename, frameShape)
+        kwargs = {'nFrames': self.nFrames, 'framesPerPlane': framesPerPlane,
+                  'attrs': self.attrs}
+        if self.main.partBytes is not None:
+            factory = writers.RolloverWriter
+            kwargs['partBytes'] = self.main.partBytes
+        else:
+            factory = writers.makeWriter
+        if self.recMode in [3, 4]:
+            # Change setting for scanning
+            self.main.main.trigsourceparam.setValue('External "frame-trigger"')
+            laserWidget = self.main.main.laserWidgets
+            laserWidget.DigCtrl.DigitalControlButton.setChecked(True)
 
             # start scanning
             self.scanWidget.scanButton.click()
-            if saveMode == 'tiff':
-                for i in range(stepsZ):
-                    name = self.savename + '_z' + str(i) + '.tiff'
-                    with tiff.TiffWriter(name, software='Tormenta') \
-                            as storeFile:
-                        while self.nStored != framesExpected*(i + 1) \
-                                and self.pressed:
-                            time.sleep(0.01)
-                            newFrames = self.lvworker.fRecorded[self.nStored:]
-                            if self.nStored + len(newFrames) \
-                                    > framesExpected*(i + 1):
-                                maxF = framesExpected*(i + 1) - self.nStored
-                                newFrames = newFrames[:maxF]
-                            self.nStored += len(newFrames)
-                            for frame in newFrames:
-                                storeFile.save(frame)
-                            self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    for i in range(stepsZ):
-                        zPlane = storeFile.create_group('z' + str(i))
-                        dataset = zPlane.create_dataset(
-                            'Images', (1, self.shape[0], self.shape[1]),
-                            maxshape=(None, self.shape[0], self.shape[1]))
-                        while self.nStored != framesExpected*(i+1)\
-                                and self.pressed:
-                            time.sleep(0.01)
-                            newFrames = self.lvworker.fRecorded[self.nStored:]
-                            if self.nStored + len(newFrames) \
-                                    > framesExpected*(i + 1):
-                                maxF = framesExpected*(i+1)-self.nStored
-                                newFrames = newFrames[:maxF]
-                            size = (self.nStored - framesExpected*i +
-                                    len(newFrames))
-                            dataset.resize(size, axis=0)
-                            dataset[self.nStored:] = newFrames
-                            self.nStored += len(newFrames)
-                            self.updateSignal.emit()
-        elif self.recMode == 5:
-            if saveMode == 'tiff':
-                with tiff.TiffWriter(self.savename + '.tiff',
-                                     software='Tormenta') as storeFile:
-                    while self.pressed:
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        self.nStored += len(newFrames)
-                        for frame in newFrames:
-                            storeFile.save(frame)
-                        self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    storeFile.create_dataset(
-                        'Images', (1, self.shape[0], self.shape[1]),
-                        maxshape=(None, self.shape[0], self.shape[1]))
-                    dataset = storeFile['Images']
-                    while self.pressed:
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        dataset.resize((self.nStored + len(newFrames)), axis=0)
-                        dataset[self.nStored:] = newFrames
-                        self.nStored += len(newFrames)
-                        self.updateSignal.emit()
-
-        self.lvworker.stopRecording()
-
-        self.done = True
-        self.doneSignal.emit()
+
+        if container:
+            if self.stackWriter is None:
+                kwargs['timePoints'] = self.main.timeLapseScan
+                self.stackWriter = factory(*args, **kwargs)
+                self.stackWriter.open()
+            self.stackWriter.nextTimePoint()
+            attrs = self.store(self.stackWriter)
+        elif inProcess:
+            attrs = self.storeInProcess(factory, args, kwargs)
+        else:
+            with factory(*args, **kwargs) as writer:
+                attrs = self.store(writer)
+        if 'tiff' in saveMode:
+            guitools.attrsToTxt(self.savename, attrs)
+        self.report()
+
+    def store(self, writer):
+        ''' Main loop storing the queued frames with the open writer until
+        recording is finished and sending update signal. Frames still in the
+        queue when it is finished are stored as well, within the expected
+        number. Returns the attributes stored with the recording.'''
+        while True:
+            running = self.recording()
+            if not running:
+                self.lvworker.unsubscribe(self.record)
+                self.queue.close()
+
+            frames, metadata = self.queue.read(timeout=0.01)
+            if self.nFrames is not None:
+                frames = frames[:self.nFrames - self.nStored]
+                if metadata is not None:
+                    metadata = metadata[:len(frames)]
+            if len(frames) > 0:
+                t0 = time.perf_counter()
+                writer.write(frames, metadata)
+                self.stats.wrote(len(frames), frames.nbytes,
+                                 time.perf_counter() - t0, metadata)
+                self.queue.release(len(frames))
+                self.nStored += len(frames)
+            elif not running:
+                break
+            self.tRecorded = time.time() - self.starttime
+            self.updateSignal.emit()
+
+        # Performance summary stored with the recording
+        writer.attrs.extend(self.stats.summary())
+        return writer.attrs
+
+    def storeInProcess(self, factory, args, kwargs):
+        ''' Same as store, but the writer runs in its own process (see
+        writers.writeProcess), reading the frames from the shared memory
+        ring of the queue, so that encoding and compression do not compete
+        for the interpreter with acquisition, the GUI and the other
+        camera. This thread only follows its progress.'''
+        results = mp.Queue()
+        process = mp.Process(target=writers.writeProcess,
+                             args=(self.queue.ring(), self.queue.descriptors,
+                                   self.queue.released, results, factory,
+                                   args, kwargs))
+        process.start()
+        try:
+            while True:
+                if not self.recording():
+                    self.lvworker.unsubscribe(self.record)
+                    self.queue.close()
+
+                try:
+                    item = results.get(timeout=0.01)
+                except queue.Empty:
+                    if not process.is_alive():
+                        raise RuntimeError('Writer process ended '
+                                           'unexpectedly')
+                    item = ()
+                if item is None:
+                    break
+                if len(item) > 0:
+                    n, nbytes, seconds, metadata = item
+                    self.stats.wrote(n, nbytes, seconds, metadata)
+                    self.nStored += n
+                self.tRecorded = time.time() - self.starttime
+                self.updateSignal.emit()
+
+            summary = self.stats.summary()
+            self.queue.descriptors.put(summary)
+            process.join()
+        finally:
+            # Nothing may write to the ring once it is gone
+            self.lvworker.unsubscribe(self.record)
+            self.queue.close()
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            self.queue.destroy()
+        return self.attrs + summary
+
+    def report(self):
+        ''' Prints the performance summary, warning about lost frames.'''
+        for name, value in self.stats.summary():
+            print(name + ':', value)
+        if not self.stats.healthy():
+            print('Warning: not all the frames were saved')
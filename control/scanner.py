@@ -611,7 +611,7 @@ class ScanWidget(QtGui.QMainWindow):
             if self.focusLocked:
                 self.focusWgt.unlockFocus()
 
-            self.main.lvworkers[0].startRecording()
+            self.main.lvworkers[0].startRecording(self.stageScan.frames)
 
             self.scanner.runScan()
 
@@ -637,7 +637,7 @@ class ScanWidget(QtGui.QMainWindow):
             if self.multiScanWgt.makeImgBox.isChecked():
 
                 # Get data
-                data = self.main.lvworkers[0].fRecorded
+                data = self.main.lvworkers[0].recBuffer.read()
 
                 # Send data to MultipleScanWidget and analyze it
                 if self.stageScan.scanMode == 'FOV scan':
@@ -0,0 +1,774 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 14 09:12:30 2026
+
+@author: Tempesta_team
+"""
+import functools
+import json
+import mmap
+import os
+import tempfile
+import time
+import numpy as np
+
+import h5py as hdf
+import tifffile as tiff
+
+import control.buffers as buffers
+
+
+class FrameWriter(object):
+    """ Common interface of the recording backends.
+
+    Frames are written in batches, as (n, x, y) arrays together with their
+    metadata records. If framesPerPlane is given the recording is a stack of
+    planes (z steps of a scan): TIFF and BigTIFF write each plane to its own
+    file, HDF5 to its own slice of the dataset and raw to the same file,
+    keeping framesPerPlane to split it when it is converted. Backends only implement open, writeFrames and close, and are used
+    as context managers:
+
+        with makeWriter('hdf5', savename, shape) as writer:
+            writer.write(frames, metadata)
+    """
+
+    def __init__(self, savename, shape, dtype=np.uint16, nFrames=None,
+                 framesPerPlane=None, attrs=None):
+        self.savename = savename
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.nFrames = nFrames
+        self.framesPerPlane = framesPerPlane
+        # (name, value) pairs of the recording settings, as getAttrs()
+        self.attrs = [] if attrs is None else list(attrs)
+        self.nWritten = 0
+        self.metadata = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, frames, metadata=None):
+        """ Writes a batch of frames, splitting it at plane boundaries."""
+        if metadata is not None:
+            self.metadata.append(np.array(metadata))
+
+        while len(frames) > 0:
+            if self.framesPerPlane is None:
+                plane, index = None, self.nWritten
+                n = len(frames)
+            else:
+                plane, index = divmod(self.nWritten, self.framesPerPlane)
+                n = min(len(frames), self.framesPerPlane - index)
+            self.writeFrames(plane, index, frames[:n])
+            self.nWritten += n
+            frames = frames[n:]
+
+    def writeFrames(self, plane, index, frames):
+        """ Writes frames to plane (None if there are no planes) starting at
+        frame index of that plane."""
+        raise NotImplementedError
+
+    def nextTimePoint(self):
+        """ Starts a new time point of a time-lapse. Only writers that
+        keep time points apart do something with it."""
+        pass
+
+    def getMetadata(self):
+        """ Metadata records of all the written frames, None if there
+        were none."""
+        if len(self.metadata) == 0:
+            return None
+        return np.concatenate(self.metadata)
+
+
+class TiffFrameWriter(FrameWriter):
+    """ One multi-page TIFF per plane, savename.tiff or savename_z<i>.tiff.
+    The frame metadata goes to savename_metadata.npy."""
+
+    def open(self):
+        self.plane = -1
+        self.storeFile = None
+
+    def fileName(self, plane):
+        if plane is None:
+            return self.savename + '.tiff'
+        return self.savename + '_z' + str(plane) + '.tiff'
+
+    def writeFrames(self, plane, index, frames):
+        if plane != self.plane or self.storeFile is None:
+            self.closeFile()
+            self.openFile(plane)
+            self.plane = plane
+        self.saveFrames(frames)
+
+    def openFile(self, plane):
+        self.storeFile = tiff.TiffWriter(self.fileName(plane),
+                                         software='Tormenta')
+
+    def saveFrames(self, frames):
+        for frame in frames:
+            self.storeFile.save(frame)
+
+    def closeFile(self):
+        if self.storeFile is not None:
+            self.storeFile.close()
+            self.storeFile = None
+
+    def close(self):
+        self.closeFile()
+        metadata = self.getMetadata()
+        if metadata is not None:
+            np.save(self.savename + '_metadata.npy', metadata)
+
+
+class BigTiffFrameWriter(TiffFrameWriter):
+    """ BigTIFF files, without the 4 GB limit of classic TIFF, written as
+    a stream: the image data of all the frames is appended contiguously in
+    bulk after the header, and the directories of the pages, with the ImageJ
+    hyperstack description in the first one, are written once at close.
+    Until then the file is not readable as a TIFF, although the frames are
+    at HEADER_BYTES + i * frameBytes."""
+
+    HEADER_BYTES = 16
+
+    # BigTIFF directory entry and field types
+    ENTRY_DTYPE = np.dtype([('tag', '<u2'), ('type', '<u2'),
+                            ('count', '<u8'), ('value', '<u8')])
+    ASCII = 2
+    SHORT = 3
+    LONG = 4
+    LONG8 = 16
+
+    def openFile(self, plane):
+        self.storeFile = open(self.fileName(plane), 'wb')
+        # Little-endian BigTIFF header, the first directory offset is
+        # patched at close.
+        self.storeFile.write(b'II' + np.array([43, 8, 0], '<u2').tobytes() +
+                             np.zeros(1, '<u8').tobytes())
+        self.nPages = 0
+
+    def saveFrames(self, frames):
+        frames = np.ascontiguousarray(frames, dtype=self.dtype)
+        self.storeFile.write(frames.data)
+        self.nPages += len(frames)
+
+    def closeFile(self):
+        if self.storeFile is None:
+            return
+        f = self.storeFile
+        self.storeFile = None
+        if self.nPages == 0:
+            f.close()
+            return
+
+        height, width = self.shape
+        frameBytes = self.dtype.itemsize * height * width
+        description = ('ImageJ=1.11a\nimages={0}\nframes={0}\n'
+                       'hyperstack=true\nmode=grayscale\nloop=false\n'
+                       '\0'.format(self.nPages)).encode('ascii')
+        software = b'Tormenta\0'
+
+        # Out of line values of the first directory
+        start = f.tell()
+        start += start % 2
+        f.seek(start)
+        f.write(description + software)
+        descriptionOffset = start
+        softwareOffset = start + len(description)
+
+        # Entries common to all the directories, sorted by tag
+        entries = [(256, self.LONG, 1, width),
+                   (257, self.LONG, 1, height),
+                   (258, self.SHORT, 1, 8 * self.dtype.itemsize),
+                   (259, self.SHORT, 1, 1),
+                   (262, self.SHORT, 1, 1),
+                   (273, self.LONG8, 1, 0),
+                   (277, self.SHORT, 1, 1),
+                   (278, self.LONG, 1, height),
+                   (279, self.LONG8, 1, frameBytes),
+                   (339, self.SHORT, 1, 1)]
+        first = sorted(entries + [
+            (270, self.ASCII, len(description), descriptionOffset),
+            (305, self.ASCII, len(software), softwareOffset)])
+        first = np.array(first, dtype=self.ENTRY_DTYPE)
+        entries = np.array(entries, dtype=self.ENTRY_DTYPE)
+        stripEntry = 5
+
+        # Directories of all the pages, built in one go
+        firstDtype = np.dtype([('count', '<u8'),
+                               ('entries', self.ENTRY_DTYPE, len(first)),
+                               ('next', '<u8')])
+        ifdDtype = np.dtype([('count', '<u8'),
+                             ('entries', self.ENTRY_DTYPE, len(entries)),
+                             ('next', '<u8')])
+        firstOffset = f.tell() + f.tell() % 2
+        offsets = (firstOffset + firstDtype.itemsize +
+                   ifdDtype.itemsize * np.arange(self.nPages - 1,
+                                                 dtype=np.uint64))
+        dataOffsets = (self.HEADER_BYTES +
+                       frameBytes * np.arange(self.nPages, dtype=np.uint64))
+
+        ifd0 = np.zeros(1, dtype=firstDtype)
+        ifd0['count'] = len(first)
+        ifd0['entries'] = first
+        ifd0['entries']['value'][0, first['tag'] == 273] = dataOffsets[0]
+        ifd0['next'] = offsets[0] if self.nPages > 1 else 0
+
+        ifds = np.zeros(self.nPages - 1, dtype=ifdDtype)
+        ifds['count'] = len(entries)
+        ifds['entries'] = entries
+        ifds['entries']['value'][:, stripEntry] = dataOffsets[1:]
+        ifds['next'][:-1] = offsets[1:]
+
+        f.seek(firstOffset)
+        f.write(ifd0.tobytes())
+        f.write(ifds.tobytes())
+        f.seek(8)
+        f.write(np.array([firstOffset], '<u8').tobytes())
+        f.close()
+
+
+class HDF5FrameWriter(FrameWriter):
+    """ savename.hdf5 with the frames in an 'Images' dataset and their
+    metadata in a 'FrameMetadata' dataset.
+
+    Frames keep the camera dtype. A plain recording is a (frame, x, y)
+    stack. Scans, with framesPerPlane, are a single (t, z, frame, x, y)
+    dataset with timePoints time points (1 by default) of all their planes
+    (if nFrames is not known they are a plain stack instead),
+    so any plane of any time point can be sliced directly; a time-lapse
+    calls nextTimePoint before each scan, which also records its start in
+    the 'TimeIndex' dataset, and keeps the file open between scans. The
+    dimensions are labelled. Datasets are chunked in whole frames of about
+    chunkBytes, never across planes, optionally compressed with a built-in
+    lossless filter (compression 'gzip' or 'lzf', after a byte shuffle).
+    They are allocated at their final size when the number of frames is
+    known, otherwise they grow by doubling, and are trimmed at close.
+
+    The file is written in single-writer/multiple-reader mode (swmr=True)
+    and flushed every flushInterval seconds: the data first, then the
+    number of frames in the 'FrameCount' dataset, so that after a crash the
+    file is valid up to FrameCount and other processes can read it while
+    it grows (see analysis.stack.LiveStack). The attributes are written
+    again, with whatever was added to attrs, once the file is closed and
+    no reader has it open, waiting up to reopenTimeout seconds for them and
+    otherwise writing them to savename.txt."""
+
+    TIME_INDEX_DTYPE = np.dtype([('time_point', np.int32),
+                                 ('first_frame', np.int64),
+                                 ('time', np.float64)])
+
+    def __init__(self, *args, compression=None, chunkBytes=1024**2,
+                 swmr=True, flushInterval=1, reopenTimeout=10,
+                 timePoints=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compression = compression
+        self.reopenTimeout = reopenTimeout
+        frameBytes = self.dtype.itemsize * int(np.prod(self.shape))
+        self.chunkFrames = max(1, chunkBytes // frameBytes)
+        self.flushInterval = flushInterval
+        self.timePoints = timePoints
+        self.swmr = swmr
+        if self.framesPerPlane is not None and self.nFrames is None:
+            # Without the number of frames there is no number of planes, the
+            # frames go to a growing (frame, x, y) stack that can be split
+            # with the framesPerPlane attribute
+            self.attrs.append(('framesPerPlane', self.framesPerPlane))
+            self.framesPerPlane = None
+        if self.framesPerPlane is not None:
+            self.planes = -(-self.nFrames // self.framesPerPlane)
+            self.timeFrames = self.planes * self.framesPerPlane
+
+    def open(self):
+        libver = 'latest' if self.swmr else None
+        self.storeFile = hdf.File(self.savename + '.hdf5', 'w',
+                                  libver=libver)
+        self.images = None
+        self.size = 0       # used length of the first axis of the images
+        self.metadataset = None
+        self.timeset = None
+        self.timeIndex = []
+        self.frameCount = self.storeFile.create_dataset(
+            'FrameCount', data=np.zeros(1, dtype=np.int64), chunks=(1,))
+        self.writeAttrs()
+        self.lastFlush = time.perf_counter()
+
+    def writeAttrs(self):
+        for name, value in self.attrs:
+            if value is not None:
+                try:
+                    self.storeFile.attrs[name] = value
+                except TypeError:
+                    self.storeFile.attrs[name] = str(value)
+
+    def createImages(self):
+        chunkFrames = self.chunkFrames
+        if self.framesPerPlane is None:
+            size = self.nFrames or chunkFrames
+            head = (size,)
+            labels = ['frame', 'x', 'y']
+        else:
+            chunkFrames = min(self.framesPerPlane, chunkFrames)
+            head = (self.timePoints or 1, self.planes, self.framesPerPlane)
+            labels = ['t', 'z', 'frame', 'x', 'y']
+            self.timeset = self.storeFile.create_dataset(
+                'TimeIndex', (0,), dtype=self.TIME_INDEX_DTYPE,
+                maxshape=(None,), chunks=(64,))
+        self.images = self.storeFile.create_dataset(
+            'Images', head + self.shape, dtype=self.dtype,
+            maxshape=(None,) + head[1:] + self.shape,
+            chunks=(1,) * (len(head) - 1) + (min(head[-1], chunkFrames),) +
+            self.shape,
+            compression=self.compression,
+            shuffle=self.compression is not None)
+        for dim, label in zip(self.images.dims, labels):
+            dim.label = label
+
+    def startSWMR(self, metadata):
+        """ Creates the remaining datasets and switches the file to SWMR."""
+        if metadata is not None:
+            self.metadataset = self.storeFile.create_dataset(
+                'FrameMetadata', (0,), dtype=metadata.dtype,
+                maxshape=(None,), chunks=(1024,))
+        self.storeFile.swmr_mode = True
+
+    def nextTimePoint(self):
+        if self.framesPerPlane is None:
+            return
+        # Time points start at whole scans, even if the last one was cut
+        if self.nWritten % self.timeFrames > 0:
+            self.nWritten += self.timeFrames - self.nWritten % self.timeFrames
+        self.timeIndex.append((self.nWritten // self.timeFrames,
+                               self.nWritten, time.time()))
+
+    def writeTimeIndex(self):
+        if self.timeset is not None and len(self.timeset) < len(
+                self.timeIndex):
+            start = len(self.timeset)
+            self.timeset.resize(len(self.timeIndex), axis=0)
+            self.timeset[start:] = np.array(self.timeIndex[start:],
+                                            dtype=self.TIME_INDEX_DTYPE)
+
+    def write(self, frames, metadata=None):
+        if self.images is None:
+            self.createImages()
+            if self.swmr:
+                self.startSWMR(metadata)
+        self.writeTimeIndex()
+        if self.metadataset is not None and metadata is not None:
+            start = len(self.metadataset)
+            self.metadataset.resize(start + len(metadata), axis=0)
+            self.metadataset[start:] = metadata
+        super().write(frames, metadata)
+        if time.perf_counter() - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+    def writeFrames(self, plane, index, frames):
+        stop = index + len(frames)
+        if plane is None:
+            position, size = slice(index, stop), stop
+        else:
+            t, z = divmod(plane, self.planes)
+            position, size = (t, z, slice(index, stop)), t + 1
+        if size > len(self.images):
+            self.images.resize(max(size, 2 * len(self.images)), axis=0)
+        self.images[position] = frames
+        self.size = max(self.size, size)
+
+    def flush(self):
+        """ Commits the frames written so far: their data, then their
+        number."""
+        if self.storeFile.swmr_mode:
+            for dataset in [self.images, self.metadataset, self.timeset]:
+                if dataset is not None:
+                    dataset.flush()
+            self.frameCount[0] = self.nWritten
+            self.frameCount.flush()
+        else:
+            self.storeFile.flush()
+            self.frameCount[0] = self.nWritten
+            self.storeFile.flush()
+        self.lastFlush = time.perf_counter()
+
+    def close(self):
+        # Trim what was allocated but not written (stopped recordings)
+        if self.images is not None:
+            self.writeTimeIndex()
+            if len(self.images) != self.size:
+                self.images.resize(self.size, axis=0)
+        self.flush()
+        if self.storeFile.swmr_mode:
+            # No objects or attributes can be created in SWMR mode, the file
+            # is opened again once the readers let go of it
+            self.storeFile.close()
+            self.storeFile = None
+            deadline = time.perf_counter() + self.reopenTimeout
+            while self.storeFile is None:
+                try:
+                    self.storeFile = hdf.File(self.savename + '.hdf5', 'r+')
+                except OSError:
+                    if time.perf_counter() > deadline:
+                        print('Recording still open by a reader, '
+                              'attributes saved to', self.savename + '.txt')
+                        with open(self.savename + '.txt', 'w') as f:
+                            f.write('\n'.join('{}= {}'.format(*attr)
+                                              for attr in self.attrs))
+                        return
+                    time.sleep(0.1)
+        metadata = self.getMetadata()
+        if self.metadataset is None and metadata is not None:
+            self.storeFile.create_dataset('FrameMetadata', data=metadata)
+        self.writeAttrs()
+        self.storeFile.close()
+
+
+class RawFrameWriter(FrameWriter):
+    """ savename.raw with the frames one after the other, as they are in
+    memory, and a savename.json sidecar with their shape, dtype, frames per
+    plane and the recording attributes. The planes of a scan are not split
+    into files, they are split by convertRaw. The frame metadata goes to
+    savename_metadata.npy.
+
+    Data goes through a page-aligned bounce buffer and is written in whole
+    blocks of blockBytes, so the file can be opened with O_DIRECT
+    (direct=True, where the system has it) to bypass the page cache. The
+    file is preallocated when the number of frames is known."""
+
+    ALIGNMENT = 4096
+
+    def __init__(self, *args, direct=False, blockBytes=8*1024**2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.direct = direct and hasattr(os, 'O_DIRECT')
+        self.blockBytes = max(self.ALIGNMENT,
+                              blockBytes - blockBytes % self.ALIGNMENT)
+        self.frameBytes = self.dtype.itemsize * int(np.prod(self.shape))
+
+    def open(self):
+        flags = (os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                 getattr(os, 'O_BINARY', 0))
+        if self.direct:
+            flags |= os.O_DIRECT
+        self.fd = os.open(self.savename + '.raw', flags, 0o644)
+        if self.nFrames is not None:
+            size = self.nFrames * self.frameBytes
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fd, 0, size)
+            else:
+                os.ftruncate(self.fd, size)
+
+        # Anonymous maps are page aligned
+        self.bounce = mmap.mmap(-1, self.blockBytes)
+        self.bounceArray = np.frombuffer(self.bounce, dtype=np.uint8)
+        self.fill = 0
+        self.size = 0
+
+    def writeFrames(self, plane, index, frames):
+        data = np.ascontiguousarray(frames, dtype=self.dtype)
+        data = data.reshape(-1).view(np.uint8)
+        done = 0
+        while done < len(data):
+            k = min(len(data) - done, self.blockBytes - self.fill)
+            self.bounceArray[self.fill:self.fill + k] = data[done:done + k]
+            self.fill += k
+            done += k
+            if self.fill == self.blockBytes:
+                self.writeBlock(self.blockBytes)
+        self.size += len(data)
+
+    def writeBlock(self, n):
+        view = memoryview(self.bounce)
+        written = 0
+        while written < n:
+            written += os.write(self.fd, view[written:n])
+        self.fill = 0
+
+    def close(self):
+        # The last block is padded to the alignment and the file trimmed
+        if self.fill > 0:
+            n = -(-self.fill // self.ALIGNMENT) * self.ALIGNMENT
+            self.bounceArray[self.fill:n] = 0
+            self.writeBlock(n)
+        os.ftruncate(self.fd, self.size)
+        os.close(self.fd)
+        del self.bounceArray
+        self.bounce.close()
+
+        info = {'shape': [self.nWritten] + list(self.shape),
+                'dtype': self.dtype.str,
+                'framesPerPlane': self.framesPerPlane,
+                'attrs': [[name, value] for name, value in self.attrs]}
+        with open(self.savename + '.json', 'w') as f:
+            json.dump(info, f, indent=1, default=toJSON)
+        metadata = self.getMetadata()
+        if metadata is not None:
+            np.save(self.savename + '_metadata.npy', metadata)
+
+
+def toJSON(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class RawReader(object):
+    """ Raw recording (see RawFrameWriter) as a read-only memmap stack of
+    (n, x, y) frames, with its metadata and attributes."""
+
+    def __init__(self, filename):
+        self.savename = os.path.splitext(filename)[0]
+        with open(self.savename + '.json') as f:
+            info = json.load(f)
+        self.shape = tuple(info['shape'])
+        self.dtype = np.dtype(info['dtype'])
+        self.framesPerPlane = info['framesPerPlane']
+        self.attrs = [tuple(item) for item in info['attrs']]
+
+        if self.shape[0] > 0:
+            self.frames = np.memmap(self.savename + '.raw', dtype=self.dtype,
+                                    mode='r', shape=self.shape)
+        else:
+            self.frames = np.zeros(self.shape, dtype=self.dtype)
+        try:
+            self.metadata = np.load(self.savename + '_metadata.npy')
+        except IOError:
+            self.metadata = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+
+def convertRaw(filename, saveMode='hdf5', batchBytes=64*1024**2):
+    """ Writes a raw recording in another format, next to it and with the
+    same name."""
+    reader = RawReader(filename)
+    n = len(reader)
+    frameBytes = reader.dtype.itemsize * int(np.prod(reader.shape[1:]))
+    batch = max(1, batchBytes // frameBytes)
+    with makeWriter(saveMode, reader.savename, reader.shape[1:],
+                    reader.dtype, nFrames=n,
+                    framesPerPlane=reader.framesPerPlane,
+                    attrs=reader.attrs) as writer:
+        for i in range(0, n, batch):
+            metadata = None
+            if reader.metadata is not None:
+                metadata = reader.metadata[i:i + batch]
+            writer.write(reader.frames[i:i + batch], metadata)
+
+
+class RolloverWriter(FrameWriter):
+    """ Splits a recording into parts, savename_part0001, savename_part0002,
+    ..., each one written by a writer of saveMode. A new part is started
+    when the current one has partFrames frames or about partBytes of data
+    (whole planes, if there are planes). Parts are switched in the recording
+    thread, while frames keep arriving to the queue, so none are dropped at
+    the boundary. savename_index.json maps the frames to the parts, see
+    RolloverIndex. Each part has the attributes there were when it was
+    closed."""
+
+    def __init__(self, saveMode, savename, shape, dtype=np.uint16,
+                 nFrames=None, framesPerPlane=None, attrs=None,
+                 partBytes=None, partFrames=None, **kwargs):
+        super().__init__(savename, shape, dtype, nFrames, framesPerPlane,
+                         attrs)
+        self.saveMode = saveMode
+        self.kwargs = kwargs
+
+        frameBytes = self.dtype.itemsize * int(np.prod(self.shape))
+        limits = [n for n in [partFrames] if n is not None]
+        if partBytes is not None:
+            limits.append(int(partBytes // frameBytes))
+        self.partFrames = max(1, min(limits)) if limits else None
+        if self.partFrames is not None and framesPerPlane is not None:
+            self.partFrames = framesPerPlane * max(
+                1, self.partFrames // framesPerPlane)
+
+    def open(self):
+        self.parts = []
+        self.writer = None
+
+    def partName(self, i):
+        return self.savename + '_part{:04d}'.format(i + 1)
+
+    def nextPart(self):
+        self.closePart()
+        nFrames = self.partFrames
+        if self.nFrames is not None:
+            nFrames = min(nFrames or self.nFrames,
+                          self.nFrames - self.nWritten)
+        name = self.partName(len(self.parts))
+        self.writer = makeWriter(self.saveMode, name, self.shape, self.dtype,
+                                 nFrames=nFrames,
+                                 framesPerPlane=self.framesPerPlane,
+                                 attrs=self.attrs, **self.kwargs)
+        self.writer.open()
+        self.partAttrs = len(self.attrs)
+        self.parts.append({'name': os.path.basename(name),
+                           'first': self.nWritten, 'frames': 0})
+
+    def closePart(self):
+        if self.writer is not None:
+            # Attributes added since the part was started, such as the
+            # summary of the recording for the last part
+            self.writer.attrs.extend(self.attrs[self.partAttrs:])
+            self.writer.close()
+            self.parts[-1]['frames'] = self.writer.nWritten
+            self.writer = None
+
+    def write(self, frames, metadata=None):
+        if metadata is not None:
+            self.metadata.append(np.array(metadata))
+
+        while len(frames) > 0:
+            if self.writer is None or (
+                    self.partFrames is not None and
+                    self.writer.nWritten >= self.partFrames):
+                self.nextPart()
+            n = len(frames)
+            if self.partFrames is not None:
+                n = min(n, self.partFrames - self.writer.nWritten)
+            self.writer.write(frames[:n],
+                              None if metadata is None else metadata[:n])
+            self.nWritten += n
+            frames = frames[n:]
+            if metadata is not None:
+                metadata = metadata[n:]
+
+    def close(self):
+        self.closePart()
+        index = {'saveMode': self.saveMode,
+                 'frames': self.nWritten,
+                 'partFrames': self.partFrames,
+                 'parts': self.parts,
+                 'attrs': [[name, value] for name, value in self.attrs]}
+        with open(self.savename + '_index.json', 'w') as f:
+            json.dump(index, f, indent=1, default=toJSON)
+
+
+class RolloverIndex(object):
+    """ Index of a recording split in parts by RolloverWriter."""
+
+    def __init__(self, filename):
+        self.folder = os.path.dirname(filename)
+        with open(filename) as f:
+            index = json.load(f)
+        self.saveMode = index['saveMode']
+        self.partFrames = index['partFrames']
+        self.parts = index['parts']
+        self.nFrames = index['frames']
+
+    def __len__(self):
+        return self.nFrames
+
+    def locate(self, frame):
+        """ Part file (without extension) and position in it of a frame of
+        the whole recording. All parts but the last one have partFrames
+        frames, so this takes no search."""
+        if not 0 <= frame < self.nFrames:
+            raise IndexError('frame {} out of range'.format(frame))
+        if self.partFrames is None:
+            part, offset = 0, frame
+        else:
+            part, offset = divmod(frame, self.partFrames)
+        return os.path.join(self.folder, self.parts[part]['name']), offset
+
+
+# Backend of each of the formats of the recording widget
+WRITERS = {'tiff': TiffFrameWriter,
+           'bigtiff': BigTiffFrameWriter,
+           'raw': RawFrameWriter,
+           'hdf5': HDF5FrameWriter,
+           'hdf5 (lzf)': functools.partial(HDF5FrameWriter, compression='lzf'),
+           'hdf5 (gzip)': functools.partial(HDF5FrameWriter,
+                                            compression='gzip')}
+
+
+def makeWriter(saveMode, savename, shape, *args, **kwargs):
+    return WRITERS[saveMode](savename, shape, *args, **kwargs)
+
+
+def writeProcess(ring, descriptors, released, results, factory, args,
+                 kwargs):
+    """ Body of a writer process fed by a buffers.SharedFrameQueue. The
+    writer is made by factory(*args, **kwargs) (makeWriter or
+    RolloverWriter) and writes the frames described in the descriptors
+    queue straight from the shared ring, up to the writer's nFrames. Every
+    batch is reported in the results queue as (n, nbytes, seconds,
+    metadata), and None once the frame queue is closed; then the process
+    waits for the final (name, value) attributes, the performance summary,
+    before closing the file."""
+    shm, data = buffers.attachRing(*ring)
+    frames = None
+    writer = factory(*args, **kwargs)
+    with writer:
+        while True:
+            item = descriptors.get()
+            if item is None:
+                break
+            start, n, metadata = item
+            k = n
+            if writer.nFrames is not None:
+                k = min(n, writer.nFrames - writer.nWritten)
+            if k > 0:
+                frames = data[start:start + k]
+                if metadata is not None:
+                    metadata = metadata[:k]
+                t0 = time.perf_counter()
+                writer.write(frames, metadata)
+                results.put((k, frames.nbytes, time.perf_counter() - t0,
+                             metadata))
+            released.value += n
+        results.put(None)
+        writer.attrs.extend(descriptors.get())
+    # No views of the ring may be left to close it
+    frames = data = None
+    shm.close()
+
+
+def syncFolder(folder):
+    """ Forces the data of the files in folder out of the OS write-back cache
+    and onto the disk."""
+    for name in os.listdir(folder):
+        with open(os.path.join(folder, name), 'rb+') as f:
+            os.fsync(f.fileno())
+
+
+def benchmark(saveMode, folder, shape, seconds=1, maxBytes=256*1024**2,
+              syncInterval=0.25):
+    """ Measures how fast frames of shape are written by a saveMode writer in
+    folder, in bytes/s. Camera-like noise is written, so that compression
+    performs as it would with data, for up to seconds or maxBytes, opening
+    and closing included, to a temporary directory that is then removed.
+    The files are synced every syncInterval seconds and at the end, so that
+    the disk is measured and not the page cache."""
+    shape = tuple(int(s) for s in shape)
+    frameBytes = 2 * int(np.prod(shape))
+    batch = max(1, min(16, 8*1024**2 // frameBytes))
+    frames = (100 + np.random.poisson(5, (batch,) + shape)).astype(np.uint16)
+
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        writer = makeWriter(saveMode, os.path.join(tmp, 'benchmark'), shape)
+        t0 = time.perf_counter()
+        lastSync = t0
+        with writer:
+            while (writer.nWritten * frameBytes < maxBytes and
+                   time.perf_counter() - t0 < seconds):
+                writer.write(frames)
+                if time.perf_counter() - lastSync > syncInterval:
+                    syncFolder(tmp)
+                    lastSync = time.perf_counter()
+        syncFolder(tmp)
+        elapsed = time.perf_counter() - t0
+    return writer.nWritten * frameBytes / elapsed
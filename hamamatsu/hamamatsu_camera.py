@@ -19,7 +19,9 @@
 
 import ctypes
 import ctypes.util
+import mmap
 import numpy as np
+import time
 
 print('hellooooooooooooooooooooooooooooooooooooooooo')
 
@@ -29,6 +31,8 @@ DCAMCAP_EVENT_FRAMEREADY = int("0x0002", 0)
 # DCAM3 API.
 DCAMERR_ERROR = 0
 DCAMERR_NOERROR = 1
+DCAMERR_ABORT = int("0x80000102", 0)
+DCAMERR_TIMEOUT = int("0x80000106", 0)
 
 DCAMPROP_ATTR_HASVALUETEXT = int("0x10000000", 0)
 DCAMPROP_ATTR_READABLE = int("0x00010000", 0)
@@ -54,6 +58,50 @@ DCAM_IDPROP_EXPOSURETIME = int("0x001F0110", 0)
 
 DCAM_IDSTR_MODEL = int("0x04000104", 0)
 
+# Properties whose values (and ranges) change when one of them, or one of the
+# frame properties, is set. Setting any other property clears the whole
+# property cache. Read-only properties that are not in these groups
+# (temperatures, status) are never cached.
+TIMING_PROPERTIES = ("exposure_time",
+                     "internal_frame_interval",
+                     "internal_frame_rate",
+                     "internal_line_interval",
+                     "timing_exposure",
+                     "timing_global_exposure_delay",
+                     "timing_min_trigger_blanking",
+                     "timing_min_trigger_interval",
+                     "timing_readout_time")
+FRAME_PROPERTIES = ("binning",
+                    "image_framebytes",
+                    "image_height",
+                    "image_rowbytes",
+                    "image_top_offset_bytes",
+                    "image_width",
+                    "subarray_hpos",
+                    "subarray_hsize",
+                    "subarray_mode",
+                    "subarray_vpos",
+                    "subarray_vsize")
+
+# Order in which setPropertyValues() writes properties, the ones that are
+# not listed go last. The frame comes before the timing that depends on it.
+PROPERTY_ORDER = ("binning",
+                  "subarray_mode",
+                  "subarray_hpos",
+                  "subarray_hsize",
+                  "subarray_vpos",
+                  "subarray_vsize",
+                  "exposure_time")
+
+# Per-frame metadata record. The frame number is the camera frame counter
+# (starting at 0 with every acquisition), the timestamp is the host
+# monotonic time (time.perf_counter) when the frame was delivered and the
+# backlog is the number of frames the camera was ahead at that point.
+FRAME_METADATA_DTYPE = np.dtype([("frame_number", np.int64),
+                                 ("buffer_index", np.int32),
+                                 ("timestamp", np.float64),
+                                 ("backlog", np.int32)])
+
 # Hamamatsu structures.
 
 ## DCAM_PARAM_PROPERTYATTR
@@ -141,9 +189,13 @@ class HCamData():
     # Create a data object of the appropriate size.
     #
     # @param size The size of the data object in bytes.
+    # @param np_array (Optional) Existing uint16 memory to use, for instance
+    #    a frame of the HamamatsuCameraMR arena, instead of allocating.
     #
-    def __init__(self, size):
-        self.np_array = np.ascontiguousarray(np.empty(np.int(size/2), dtype=np.uint16))
+    def __init__(self, size, np_array = None):
+        if np_array is None:
+            np_array = np.empty(np.int(size/2), dtype=np.uint16)
+        self.np_array = np.ascontiguousarray(np_array)
         self.size = size
 
     ## __getitem__
@@ -178,6 +230,127 @@ class HCamData():
         return self.np_array.ctypes.data
 
 
+## HCamFrame
+#
+# Read-only view of a frame in the attached buffers of HamamatsuCameraMR.
+#
+# No data is copied, the view points straight into the memory the camera
+# writes to. Each frame carries its sequence number (the camera frame
+# counter) so that consumers can check with isValid() that the buffer has
+# not been recycled by the camera in the meantime.
+#
+class HCamFrame():
+
+    ## __init__
+    #
+    # @param camera The HamamatsuCameraMR object owning the buffers.
+    # @param metadata The FRAME_METADATA_DTYPE record of the frame.
+    #
+    def __init__(self, camera, metadata):
+        self.camera = camera
+        self.metadata = metadata
+        self.index = int(metadata["buffer_index"])
+        self.number = int(metadata["frame_number"])
+        self.frame_x = camera.frame_x
+        self.frame_y = camera.frame_y
+        self.np_array = camera.hcam_data[self.index].view()
+        self.np_array.flags.writeable = False
+
+    ## getData
+    #
+    # @return A read-only numpy array view of the frame data.
+    #
+    def getData(self):
+        return self.np_array
+
+    ## getImage
+    #
+    # @return A read-only (frame x size, frame y size) view of the frame.
+    #
+    def getImage(self):
+        return np.reshape(self.np_array, (self.frame_x, self.frame_y), 'F')
+
+    ## isValid
+    #
+    # @return True if the camera has not yet reused the buffer of this frame.
+    #
+    def isValid(self):
+        return self.camera.isFrameValid(self.number)
+
+
+## HCamRun
+#
+# Read-only view of a run of consecutive frames, that is frames stored in
+# consecutive buffers of a HamamatsuCameraMR. The whole run can be copied
+# or written with a single operation.
+#
+class HCamRun():
+
+    ## __init__
+    #
+    # @param camera The HamamatsuCameraMR object owning the buffers.
+    # @param start The index of the first buffer of the run.
+    # @param stop The index after the last buffer of the run.
+    # @param metadata The FRAME_METADATA_DTYPE records of the frames.
+    #
+    def __init__(self, camera, start, stop, metadata):
+        self.camera = camera
+        self.start = start
+        self.stop = stop
+        self.metadata = metadata
+        self.numbers = metadata["frame_number"]
+        self.number = int(self.numbers[0])
+        self.frame_x = camera.frame_x
+        self.frame_y = camera.frame_y
+        self.np_array = camera.hcam_data[start:stop].view()
+        self.np_array.flags.writeable = False
+
+    ## __len__
+    #
+    # @return The number of frames in the run.
+    #
+    def __len__(self):
+        return self.stop - self.start
+
+    ## getData
+    #
+    # @return A read-only (frames, words) view of the run.
+    #
+    def getData(self):
+        return self.np_array
+
+    ## getImage
+    #
+    # @param i (Optional) The frame of the run, by default the last one.
+    #
+    # @return A read-only (frame x size, frame y size) view of one frame.
+    #
+    def getImage(self, i = -1):
+        return np.reshape(self.np_array[i], (self.frame_x, self.frame_y), 'F')
+
+    ## getImages
+    #
+    # @return A read-only (frames, frame x size, frame y size) view of the run.
+    #
+    def getImages(self):
+        images = self.np_array.reshape(len(self), self.frame_y, self.frame_x)
+        return images.transpose(0, 2, 1)
+
+    ## countInvalid
+    #
+    # @return The number of frames of the run the camera has already reused.
+    #
+    def countInvalid(self):
+        return int(np.count_nonzero(~self.camera.isFrameValid(self.numbers)))
+
+    ## isValid
+    #
+    # @return True if the camera has not yet reused any buffer of this run.
+    #
+    def isValid(self):
+        return self.camera.isFrameValid(self.number)
+
+
 ## HamamatsuCamera
 #
 # Basic camera interface class.
@@ -197,6 +370,7 @@ class HamamatsuCamera():
     #
     def __init__(self, camera_id):
 
+        self.acquiring = False
         self.buffer_index = 0
         self.camera_id = camera_id
         self.camera_model = self.getModelInfo(camera_id)
@@ -204,11 +378,18 @@ class HamamatsuCamera():
         self.frame_bytes = 0
         self.frame_x = 0
         self.frame_y = 0
+        self.frame_metadata = np.zeros(0, dtype = FRAME_METADATA_DTYPE)
         self.last_frame_number = 0
         self.properties = {}
         self.max_backlog = 0
         self.number_image_buffers = 0
 
+        # Cached property values, attributes and text options, see
+        # clearPropertyCache().
+        self.property_cache = {}
+        self.attribute_cache = {}
+        self.text_cache = {}
+
         # Open the camera.
         self.camera_handle = ctypes.c_void_p(0)
         self.checkStatus(dcam.dcam_open(ctypes.byref(self.camera_handle),
@@ -230,6 +411,7 @@ class HamamatsuCamera():
     def captureSetup(self):
         self.buffer_index = -1
         self.last_frame_number = 0
+        self.clearPropertyCache()
 
         # Set sub array mode.
         self.setSubArrayMode()
@@ -264,6 +446,40 @@ class HamamatsuCamera():
             #print "dcam error", fn_name, c_buf.value
         return fn_return
 
+    ## clearPropertyCache
+    #
+    # Forget cached property values, attributes and text options.
+    #
+    # @param property_names (Optional) Only forget these properties.
+    #
+    def clearPropertyCache(self, property_names = None):
+        if property_names is None:
+            self.property_cache.clear()
+            self.attribute_cache.clear()
+            self.text_cache.clear()
+        else:
+            for name in property_names:
+                self.property_cache.pop(name, None)
+                self.attribute_cache.pop(name, None)
+                self.text_cache.pop(name, None)
+
+    ## convertPropertyValue
+    #
+    # Convert a raw (double) property value based on its attribute type.
+    #
+    # @return [the property value, the property type]
+    #
+    def convertPropertyValue(self, prop_attr, value):
+        temp = prop_attr.attribute & DCAMPROP_TYPE_MASK
+        if (temp == DCAMPROP_TYPE_MODE):
+            return [int(value), "MODE"]
+        elif (temp == DCAMPROP_TYPE_LONG):
+            return [int(value), "LONG"]
+        elif (temp == DCAMPROP_TYPE_REAL):
+            return [value, "REAL"]
+        else:
+            return [False, "NONE"]
+
     ## getCameraProperties
     #
     # Return the ids & names of all the properties that the camera supports. This
@@ -319,11 +535,13 @@ class HamamatsuCamera():
     # This will block waiting for new frames even if 
     # there new frames available when it is called.
     #
+    # @param timeout (Optional) Maximum time to wait in milliseconds.
+    #
     # @return [frames, [frame x size, frame y size]]
     #
-    def getFrames(self):
+    def getFrames(self, timeout = DCAMWAIT_TIMEOUT_INFINITE):
         frames = []
-        for n in self.newFrames():
+        for n in self.newFrames(timeout):
 
             # Lock the frame in the camera buffer & get address.
             data_address = ctypes.c_void_p(0)
@@ -349,6 +567,18 @@ class HamamatsuCamera():
 
         return [frames, [self.frame_x, self.frame_y]]
         
+    ## getLastError
+    #
+    # @return The (unsigned) code of the last dcam error.
+    #
+    def getLastError(self):
+        c_buf_len = 80
+        c_buf = ctypes.create_string_buffer(c_buf_len)
+        c_error = dcam.dcam_getlasterror(self.camera_handle,
+                                         c_buf,
+                                         ctypes.c_int32(c_buf_len))
+        return c_error & 0xFFFFFFFF
+
     ## getModelInfo
     #
     # Returns the model of the camera
@@ -388,6 +618,8 @@ class HamamatsuCamera():
     # @return A DCAM_PARAM_PROPERTYATTR object.
     #
     def getPropertyAttribute(self, property_name):
+        if property_name in self.attribute_cache:
+            return self.attribute_cache[property_name]
         p_attr = DCAM_PARAM_PROPERTYATTR()
         p_attr.cbSize = ctypes.sizeof(p_attr)
         p_attr.iProp = self.properties[property_name]
@@ -398,6 +630,7 @@ class HamamatsuCamera():
             print(" property", property_id, "is not supported")
             return False
         else:
+            self.attribute_cache[property_name] = p_attr
             return p_attr
 
     ## getPropertyText
@@ -409,6 +642,8 @@ class HamamatsuCamera():
     # @return A dictionary of text properties (which may be empty).
     #
     def getPropertyText(self, property_name):
+        if property_name in self.text_cache:
+            return self.text_cache[property_name]
         prop_attr = self.getPropertyAttribute(property_name)
         if not (prop_attr.attribute & DCAMPROP_ATTR_HASVALUETEXT):
             return {}
@@ -446,6 +681,7 @@ class HamamatsuCamera():
                 if (ret == 0):
                     done = True
 
+            self.text_cache[property_name] = text_options
             return text_options
 
     ## getPropertyRange
@@ -490,7 +726,8 @@ class HamamatsuCamera():
 
     ## getPropertyVale
     #
-    # Return the current setting of a particular property.
+    # Return the current setting of a particular property. Values are read
+    # through the property cache.
     #
     # @param property_name The name of the property.
     #
@@ -502,6 +739,8 @@ class HamamatsuCamera():
         if not (property_name in self.properties):
             print(" unknown property name:", property_name)
             return False
+        if property_name in self.property_cache:
+            return list(self.property_cache[property_name])
         prop_id = self.properties[property_name]
 
         # Get the property attributes.
@@ -515,21 +754,33 @@ class HamamatsuCamera():
                          "dcam_getpropertyvalue")
 
         # Convert type based on attribute type.
-        temp = prop_attr.attribute & DCAMPROP_TYPE_MASK
-        if (temp == DCAMPROP_TYPE_MODE):
-            prop_type = "MODE"
-            prop_value = int(c_value.value)
-        elif (temp == DCAMPROP_TYPE_LONG):
-            prop_type = "LONG"
-            prop_value = int(c_value.value)
-        elif (temp == DCAMPROP_TYPE_REAL):
-            prop_type = "REAL"
-            prop_value = c_value.value
+        value = self.convertPropertyValue(prop_attr, c_value.value)
+        if self.isCacheable(property_name, prop_attr):
+            self.property_cache[property_name] = value
+        return list(value)
+
+    ## invalidateProperties
+    #
+    # Forget the cached properties that may change when a property is set.
+    #
+    # @param property_name The name of the property that was set.
+    #
+    def invalidateProperties(self, property_name):
+        if property_name in TIMING_PROPERTIES:
+            self.clearPropertyCache(TIMING_PROPERTIES)
+        elif property_name in FRAME_PROPERTIES:
+            self.clearPropertyCache(FRAME_PROPERTIES + TIMING_PROPERTIES)
         else:
-            prop_type = "NONE"
-            prop_value = False
-    
-        return [prop_value, prop_type]
+            self.clearPropertyCache()
+
+    ## isCacheable
+    #
+    # @return True/False if the value of a property can be cached.
+    #
+    def isCacheable(self, property_name, prop_attr):
+        if (prop_attr.attribute & DCAMPROP_ATTR_WRITABLE):
+            return True
+        return (property_name in TIMING_PROPERTIES) or (property_name in FRAME_PROPERTIES)
 
     ## isCameraProperty
     #
@@ -545,23 +796,34 @@ class HamamatsuCamera():
         else:
             return False
 
-    ## newFrames
+    ## newFrameRuns
     #
-    # Return a list of the ids of all the new frames since the last check.
+    # Return the buffer index ranges of all the new frames since the last
+    # check. As the ring of buffers wraps at most once there are at most two
+    # ranges, the second one starting at buffer 0. The metadata
+    # (FRAME_METADATA_DTYPE) of the new frames is left in self.frame_metadata.
     #
-    # This will block waiting for at least one new frame. 
+    # This will block waiting for at least one new frame, or until the
+    # timeout expires or the capture is stopped (dcam_idle) from another
+    # thread. In the last two cases the list is empty.
     #
-    # @return [id of the first frame, .. , id of the last frame]
+    # @param timeout (Optional) Maximum time to wait in milliseconds.
+    #
+    # @return [(start, stop), ..] with stop excluded.
     #
-    def newFrames(self):
+    def newFrameRuns(self, timeout = DCAMWAIT_TIMEOUT_INFINITE):
 
         # Wait for a new frame.
         dwait = ctypes.c_int(DCAMCAP_EVENT_FRAMEREADY)
-        self.checkStatus(dcam.dcam_wait(self.camera_handle,
-                                        ctypes.byref(dwait),
-                                        ctypes.c_int(DCAMWAIT_TIMEOUT_INFINITE),
-                                        None),
-                         "dcam_wait")
+        ret = dcam.dcam_wait(self.camera_handle,
+                             ctypes.byref(dwait),
+                             ctypes.c_int(timeout),
+                             None)
+        if (ret == DCAMERR_ERROR):
+            if (self.getLastError() in [DCAMERR_TIMEOUT, DCAMERR_ABORT]):
+                self.frame_metadata = self.frame_metadata[:0]
+                return []
+            self.checkStatus(ret, "dcam_wait")
 
         # Check how many new frames there are.
         b_index = ctypes.c_int32(0)
@@ -583,22 +845,43 @@ class HamamatsuCamera():
 
         cur_buffer_index = b_index.value
 
-        # Create a list of the new frames.
-        new_frames = []
+        # The ranges of the new frames.
+        runs = []
         if (cur_buffer_index < self.buffer_index):
-            for i in range(self.buffer_index + 1, self.number_image_buffers):
-                new_frames.append(i)
-            for i in range(cur_buffer_index + 1):
-                new_frames.append(i)
-        else:
-            for i in range(self.buffer_index, cur_buffer_index):
-                new_frames.append(i+1)
+            if (self.buffer_index + 1 < self.number_image_buffers):
+                runs.append((self.buffer_index + 1, self.number_image_buffers))
+            runs.append((0, cur_buffer_index + 1))
+        elif (cur_buffer_index > self.buffer_index):
+            runs.append((self.buffer_index + 1, cur_buffer_index + 1))
         self.buffer_index = cur_buffer_index
 
+        # Metadata of the new frames, the newest one has the current count.
+        n_new = sum(stop - start for start, stop in runs)
+        metadata = np.empty(n_new, dtype = FRAME_METADATA_DTYPE)
+        metadata["frame_number"] = np.arange(cur_frame_number - n_new, cur_frame_number)
+        metadata["buffer_index"] = np.concatenate([np.arange(start, stop) for start, stop in runs]
+                                                  + [np.zeros(0, dtype = np.int32)])
+        metadata["timestamp"] = time.perf_counter()
+        metadata["backlog"] = backlog
+        self.frame_metadata = metadata
+
         if self.debug:
-            print(new_frames)
+            print(runs)
 
-        return new_frames
+        return runs
+
+    ## newFrames
+    #
+    # Return a list of the ids of all the new frames since the last check.
+    # Like newFrameRuns() this will block waiting for at least one new frame.
+    #
+    # @param timeout (Optional) Maximum time to wait in milliseconds.
+    #
+    # @return [id of the first frame, .. , id of the last frame]
+    #
+    def newFrames(self, timeout = DCAMWAIT_TIMEOUT_INFINITE):
+        self.newFrameRuns(timeout)
+        return self.frame_metadata["buffer_index"].tolist()
 
     ## setPropertyValue
     #
@@ -633,6 +916,11 @@ class HamamatsuCamera():
             print(" set property value", property_value, "is greater than maximum of", pv_max, property_name, "setting to maximum")
             property_value = pv_max
         
+        # Nothing to do if the camera already has that value.
+        cached = self.property_cache.get(property_name)
+        if (cached is not None) and (cached[0] == property_value):
+            return cached[0]
+
         # Set the property value, return what it was set too.
         prop_id = self.properties[property_name]
         p_value = ctypes.c_double(property_value)
@@ -641,8 +929,48 @@ class HamamatsuCamera():
                                                        ctypes.byref(p_value),
                                                        ctypes.c_int32(DCAM_DEFAULT_ARG)),
                          "dcam_setgetpropertyvalue")
+
+        # Write through the cache once the camera accepted the value.
+        self.invalidateProperties(property_name)
+        prop_attr = self.getPropertyAttribute(property_name)
+        if self.isCacheable(property_name, prop_attr):
+            self.property_cache[property_name] = self.convertPropertyValue(prop_attr, p_value.value)
         return p_value.value
 
+    ## setPropertyValues
+    #
+    # Set several properties at once. Only the values that differ from the
+    # current ones are written, in dependency order (PROPERTY_ORDER). The
+    # position and size of the sub array are ordered so that position plus
+    # size never exceeds the chip in between.
+    #
+    # @param property_values A dictionary or a list of (name, value) pairs.
+    #
+    # @return A dictionary with the values the properties were set to.
+    #
+    def setPropertyValues(self, property_values):
+        values = dict(property_values)
+
+        def rank(name):
+            if name in PROPERTY_ORDER:
+                return PROPERTY_ORDER.index(name)
+            return len(PROPERTY_ORDER)
+        names = sorted(values, key = rank)
+
+        # Shrink the sub array before moving it towards the edge of the chip.
+        for pos, size, max_size in [("subarray_hpos", "subarray_hsize", self.max_width),
+                                    ("subarray_vpos", "subarray_vsize", self.max_height)]:
+            if (pos in values) and (size in values):
+                cur_size = self.getPropertyValue(size)[0]
+                if (values[pos] + cur_size > max_size):
+                    i, j = names.index(pos), names.index(size)
+                    names[i], names[j] = names[j], names[i]
+
+        set_values = {}
+        for name in names:
+            set_values[name] = self.setPropertyValue(name, values[name])
+        return set_values
+
     ## setSubArrayMode
     #
     # This sets the sub-array mode as appropriate based on the current ROI.
@@ -679,6 +1007,7 @@ class HamamatsuCamera():
         # Start acquisition.
         self.checkStatus(dcam.dcam_capture(self.camera_handle),
                          "dcam_capture")
+        self.acquiring = True
 
     ## stopAcquisition
     #
@@ -687,8 +1016,10 @@ class HamamatsuCamera():
     def stopAcquisition(self):
 
         # Stop acquisition.
+        self.acquiring = False
         self.checkStatus(dcam.dcam_idle(self.camera_handle),
                          "dcam_idle")
+        self.clearPropertyCache()
 
         print("max camera backlog was", self.max_backlog, "of", self.number_image_buffers)
         self.max_backlog = 0
@@ -733,12 +1064,16 @@ class HamamatsuCameraMR(HamamatsuCamera):
     ## __init__
     #
     # @param camera_id The id of the camera.
+    # @param buffer_budget (Optional) Bytes of memory for the frame buffers.
     #
-    def __init__(self, camera_id):
+    def __init__(self, camera_id, buffer_budget = 2 * 1024 * 1024 * 1024):
         HamamatsuCamera.__init__(self, camera_id)
 
-        self.hcam_data = []
+        self.buffer_budget = buffer_budget
+        self.arena = None
+        self.hcam_data = np.zeros((0, 0), dtype = np.uint16)
         self.hcam_ptr = False
+        self.hcam_ptr_values = None
         self.old_frame_bytes = -1
 
         self.setPropertyValue("output_trigger_kind[0]", 2)
@@ -753,41 +1088,112 @@ class HamamatsuCameraMR(HamamatsuCamera):
     # FIXME: It does not always seem to block? The length of frames can
     #   be zero. Are frames getting dropped? Some sort of race condition?
     #
+    # @param timeout (Optional) Maximum time to wait in milliseconds.
+    #
     # @return [frames, [frame x size, frame y size]]
     #
-    def getFrames(self):
+    def getFrames(self, timeout = DCAMWAIT_TIMEOUT_INFINITE):
         frames = []
-        for n in self.newFrames():
-            frames.append(self.hcam_data[n])
+        for n in self.newFrames(timeout):
+            frames.append(HCamData(self.frame_bytes, self.hcam_data[n]))
 
         return [frames, [self.frame_x, self.frame_y]]
 
+    ## getFrameViews
+    #
+    # Gets all of the available frames as read-only views into the camera
+    # buffers (no copy). Like getFrames() this will block waiting for
+    # new frames.
+    #
+    # @param timeout (Optional) Maximum time to wait in milliseconds.
+    #
+    # @return [HCamFrame, .., HCamFrame]
+    #
+    def getFrameViews(self, timeout = DCAMWAIT_TIMEOUT_INFINITE):
+        self.newFrames(timeout)
+        return [HCamFrame(self, metadata) for metadata in self.frame_metadata]
+
+    ## getFrameRuns
+    #
+    # Gets all of the available frames as at most two read-only views of
+    # consecutive buffers (no copy). Like getFrames() this will block
+    # waiting for new frames.
+    #
+    # @param timeout (Optional) Maximum time to wait in milliseconds.
+    #
+    # @return [HCamRun, ..]
+    #
+    def getFrameRuns(self, timeout = DCAMWAIT_TIMEOUT_INFINITE):
+        runs = []
+        first = 0
+        for start, stop in self.newFrameRuns(timeout):
+            metadata = self.frame_metadata[first:first + stop - start]
+            runs.append(HCamRun(self, start, stop, metadata))
+            first += stop - start
+        return runs
+
+    ## isFrameValid
+    #
+    # A frame is valid as long as the camera has not written a full ring
+    # of buffers after it (as of the last transfer info).
+    #
+    # @param number The sequence number of the frame (or an array of them).
+    #
+    # @return True/False if the buffer still contains that frame.
+    #
+    def isFrameValid(self, number):
+        return (self.last_frame_number - number) <= self.number_image_buffers
+
+    ## allocateArena
+    #
+    # Allocate the memory for the frame buffers, once. The arena takes the
+    # whole buffer budget (at least one full chip frame) and starts on a
+    # page boundary.
+    #
+    def allocateArena(self):
+        page = mmap.PAGESIZE
+        max_frame_bytes = 2 * self.max_width * self.max_height
+        size = max(self.buffer_budget, max_frame_bytes)
+        size -= size % page
+        raw = np.empty(size + page, dtype = np.uint8)
+        offset = (-raw.ctypes.data) % page
+        self.arena = raw[offset:offset + size].view(np.uint16)
+
+    ## setFrameBuffers
+    #
+    # Carve the arena into as many buffers of frame_bytes as it can hold
+    # and build the pointer table that is handed to dcam_attachbuffer.
+    # This only involves views, no memory is allocated.
+    #
+    def setFrameBuffers(self):
+        if self.arena is None:
+            self.allocateArena()
+
+        frame_words = int(self.frame_bytes / 2)
+        self.number_image_buffers = int(self.arena.size / frame_words)
+        self.hcam_data = self.arena[:self.number_image_buffers * frame_words].reshape(
+            self.number_image_buffers, frame_words)
+
+        # The pointer table shares memory with a numpy array of addresses.
+        self.hcam_ptr_values = (self.arena.ctypes.data
+                                + self.frame_bytes * np.arange(self.number_image_buffers,
+                                                               dtype = np.uintp))
+        ptr_array = ctypes.c_void_p * self.number_image_buffers
+        self.hcam_ptr = ptr_array.from_buffer(self.hcam_ptr_values)
+
+        self.old_frame_bytes = self.frame_bytes
+
     ## startAcquisition
     #
-    # Allocate as many frames as will fit in 2GB of memory and start data acquisition.
+    # Attach frame buffers that fit in the buffer budget and start data acquisition.
     #
     def startAcquisition(self):
         self.captureSetup()
         print(self.frame_bytes)
-        #
-        # Allocate new image buffers if necessary.
-        # Allocate as many frames as can fit in 2GB of memory.
-        #
-        if (self.old_frame_bytes != self.frame_bytes):
-
-            n_buffers = int((2.0 * 1024 * 1024 * 1024)/self.frame_bytes)
-            self.number_image_buffers = n_buffers
 
-            # Allocate new image buffers.
-            ptr_array = ctypes.c_void_p * self.number_image_buffers
-            self.hcam_ptr = ptr_array()
-            self.hcam_data = []
-            for i in range(self.number_image_buffers):
-                hc_data = HCamData(self.frame_bytes)
-                self.hcam_ptr[i] = hc_data.getDataPtr()
-                self.hcam_data.append(hc_data)
-
-            self.old_frame_bytes = self.frame_bytes
+        # Re-carve the buffers if the frame size changed.
+        if (self.old_frame_bytes != self.frame_bytes):
+            self.setFrameBuffers()
 
         # Attach image buffers.
         #
@@ -802,6 +1208,7 @@ class HamamatsuCameraMR(HamamatsuCamera):
         # Start acquisition.
         self.checkStatus(dcam.dcam_capture(self.camera_handle),
                          "dcam_capture")
+        self.acquiring = True
 
     ## stopAcquisition
     #
@@ -810,8 +1217,10 @@ class HamamatsuCameraMR(HamamatsuCamera):
     def stopAcquisition(self):
 
         # Stop acquisition.
+        self.acquiring = False
         self.checkStatus(dcam.dcam_idle(self.camera_handle),
                          "dcam_idle")
+        self.clearPropertyCache()
 
         # Release image buffers.
         if (self.hcam_ptr):